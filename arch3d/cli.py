@@ -2,36 +2,32 @@ import argparse
 import os
 import sys
 import subprocess
-import yaml
-import re
-import json
-import requests
-import pandas as pd
 import pathlib
-from collections import defaultdict
-from arch3d.utils import *
+
+# Heavy dependencies (pandas, requests, yaml) are imported by the subcommands that use them,
+# so --help, unlock and lookup start quickly
 
 #####
 # arch3d installation path
 #####
 
-PACKAGE_DIR = Path(__file__).parent
+PACKAGE_DIR = pathlib.Path(__file__).parent
 CONFIG_PATH = PACKAGE_DIR / "workflow" / "config.yaml"
 
 def load_config():
     """Load fixed variables from config.yaml."""
+    import yaml
     if CONFIG_PATH.exists():
         with open(CONFIG_PATH, "r") as f:
             return yaml.safe_load(f)
     return {}
 
-config_vars = load_config()
-
 #####
 # Function definitions
 #####
 
 def unlock_snakemake(output_dir, profile):
+    config_vars = load_config()
     unlock_command = [
         "/bin/bash", "-c",  # Ensures the module system works properly
         f"module load {config_vars['SNAKEMAKE_MODULE']} && "
@@ -46,7 +42,14 @@ def unlock_snakemake(output_dir, profile):
     subprocess.run(unlock_command, shell=False, check=True)
     print(f"The output directory {output_dir} has been succesfully unlocked.")
 
-def run_snakemake(workflow, output_dir, connections, profile):
+def run_snakemake(workflow, output_dir, connections, profile, batch_size=1, webin=None, registry=None, checksums=False):
+    config_vars = load_config()
+    extra_config = f" checksums={str(checksums).lower()}"
+    # The webin account makes merge_output add the uploaded samples to the sample registry
+    if webin and registry is not False:
+        extra_config += f" webin={webin}"
+        if registry:
+            extra_config += f" registry={pathlib.Path(registry).resolve()}"
     snakemake_command = [
         "/bin/bash", "-c",
         f"module load {config_vars['SNAKEMAKE_MODULE']} && "
@@ -56,7 +59,7 @@ def run_snakemake(workflow, output_dir, connections, profile):
         f"--jobs {connections} "
         f"--workflow-profile {PACKAGE_DIR / 'profile' / profile} "
         f"--configfile {CONFIG_PATH} "
-        f"--config package_dir={PACKAGE_DIR} workflow={workflow} output_dir={output_dir}"
+        f"--config package_dir={PACKAGE_DIR} workflow={workflow} output_dir={output_dir} batch_size={batch_size}{extra_config}"
     ]
     subprocess.run(snakemake_command, shell=False, check=True)
 
@@ -78,7 +81,15 @@ def main():
     subparser_macro.add_argument("-o", "--output", required=True, type=pathlib.Path, help="Output directory")
     subparser_macro.add_argument("-u", "--username", required=True, help="EBI Webin username. e.g, Webin-12345")
     subparser_macro.add_argument("-p", "--password", required=True, help="EBI Webin password")
-    subparser_macro.add_argument("-c", "--connections", required=False, default=16, help="Number of concurrent connections for uploading data")
+    subparser_macro.add_argument("-c", "--connections", required=False, type=int, default=16, help="Number of concurrent connections for uploading data")
+    subparser_macro.add_argument("-e", "--executor", required=False, choices=["slurm", "local"], default="slurm", help="Run the upload jobs through Snakemake on SLURM, or directly on this machine with at most --connections concurrent uploads (requires ena-upload-cli in PATH). Default is slurm.")
+    subparser_macro.add_argument("-b", "--batch-size", required=False, type=int, default=1, help="Number of samples uploaded together by each upload job. Default is 1.")
+    subparser_macro.add_argument("-w", "--workers", required=False, type=int, default=1, help="Number of local processes for preparing checklists and checksums. Default is 1.")
+    subparser_macro.add_argument("--preflight", required=False, action="store_true", help="Check the metadata and data files (existence, gzip integrity, FASTQ structure) before uploading")
+    subparser_macro.add_argument("--no-checksums", required=False, action="store_true", help="Do not precompute MD5 checksums; leave them to the upload jobs")
+    subparser_macro.add_argument("--registry", required=False, default=None, help="Sample registry file, updated with the uploaded samples. Default is ~/.local/share/arch3d/registry.sqlite")
+    subparser_macro.add_argument("--no-registry", required=False, action="store_true", help="Do not add the uploaded samples to the sample registry")
+    subparser_macro.add_argument("--chunksize", required=False, type=int, default=None, help="Read the metadata table in chunks of this many rows, keeping memory use flat for very large tables")
 
     # Arguments for MICRO sample data
     subparser_micro = subparsers.add_parser("microsample", help="Upload micro-scale nucleotide data to ENA")
@@ -87,14 +98,46 @@ def main():
     subparser_micro.add_argument("-o", "--output", required=True, type=pathlib.Path, help="Output directory")
     subparser_micro.add_argument("-u", "--username", required=True, help="EBI Webin username. e.g, Webin-12345")
     subparser_micro.add_argument("-p", "--password", required=True, help="EBI Webin password")
-    subparser_micro.add_argument("-c", "--connections", required=False, default=16, help="Number of concurrent connections for uploading data")
+    subparser_micro.add_argument("-c", "--connections", required=False, type=int, default=16, help="Number of concurrent connections for uploading data")
+    subparser_micro.add_argument("-e", "--executor", required=False, choices=["slurm", "local"], default="slurm", help="Run the upload jobs through Snakemake on SLURM, or directly on this machine with at most --connections concurrent uploads (requires ena-upload-cli in PATH). Default is slurm.")
+    subparser_micro.add_argument("-b", "--batch-size", required=False, type=int, default=1, help="Number of samples uploaded together by each upload job. Default is 1.")
+    subparser_micro.add_argument("-w", "--workers", required=False, type=int, default=1, help="Number of local processes for preparing checklists and checksums. Default is 1.")
+    subparser_micro.add_argument("--preflight", required=False, action="store_true", help="Check the metadata and data files (existence, gzip integrity, FASTQ structure) before uploading")
+    subparser_micro.add_argument("--no-spatial-check", required=False, action="store_true", help="Do not check the microsample coordinates (duplicates, overlapping capture spots, pixel/coordinate mismatches) before writing the checklists")
+    subparser_micro.add_argument("--no-checksums", required=False, action="store_true", help="Do not precompute MD5 checksums; leave them to the upload jobs")
+    subparser_micro.add_argument("--registry", required=False, default=None, help="Sample registry file, updated with the uploaded samples. Default is ~/.local/share/arch3d/registry.sqlite")
+    subparser_micro.add_argument("--no-registry", required=False, action="store_true", help="Do not add the uploaded samples to the sample registry")
+    subparser_micro.add_argument("--chunksize", required=False, type=int, default=None, help="Read the metadata table in chunks of this many rows, keeping memory use flat for very large tables")
 
     # Arguments for BioSample data
     subparser_animal = subparsers.add_parser("biosample", help="Upload specimen, segment of microsection metadata to BioSamples")
-    subparser_animal.add_argument("-i", "--input", required=True, help="Input metadata table")
+    subparser_animal.add_argument("-i", "--input", required=True, nargs="+", help="Input metadata table(s). Several related tables (e.g. animal, cryosection and microsample) are submitted together, level by level")
     subparser_animal.add_argument("-o", "--output", required=True, type=pathlib.Path, help="Output directory")
     subparser_animal.add_argument("-u", "--username", required=True, help="EBI Webin username. e.g, Webin-12345")
     subparser_animal.add_argument("-p", "--password", required=True, help="EBI Webin password")
+    subparser_animal.add_argument("-w", "--workers", required=False, type=int, default=1, help="Number of samples submitted concurrently. Default is 1.")
+    subparser_animal.add_argument("--skip-unchanged", required=False, choices=["local", "remote"], default=None, help="Only send updates for samples that changed, compared with the payloads recorded in the output journal (local) or with the current BioSamples records (remote)")
+    subparser_animal.add_argument("--ebi-url", required=False, default=None, help="Base URL of the EBI services, e.g. a local mock service for testing. Default is https://www.ebi.ac.uk")
+    subparser_animal.add_argument("--chunksize", required=False, type=int, default=None, help="Read, submit and save a single input table in chunks of this many rows, keeping memory use flat for very large tables")
+    subparser_animal.add_argument("--response-format", required=False, choices=["archive", "json"], default="archive", help="Store API responses in a compressed archive (output/responses) or as one JSON file per response (output/json). Default is archive")
+    subparser_animal.add_argument("--registry", required=False, default=None, help="Sample registry file, used to find samples created before and updated with every submitted sample. Default is ~/.local/share/arch3d/registry.sqlite")
+    subparser_animal.add_argument("--no-registry", required=False, action="store_true", help="Do not use the sample registry")
+    subparser_animal.add_argument("--resume", required=False, action="store_true", help="Resume an interrupted submission, skipping the steps recorded in the output journal")
+
+    # Arguments for linking
+    subparser_link = subparsers.add_parser("link", help="Fill the child_samples of BioSample sheets from ENA receipt tables")
+    subparser_link.add_argument("-r", "--receipts", required=True, nargs="+", help="data_submission.tsv table(s) of arch3d macro or micro")
+    subparser_link.add_argument("-m", "--metadata", required=True, nargs="+", help="Metadata table(s) used for the ENA upload, giving the parent of every sample")
+    subparser_link.add_argument("-i", "--input", required=True, nargs="+", help="BioSample sheet(s) of the parents, e.g. cryosection and animal tables")
+    subparser_link.add_argument("-o", "--output", required=True, type=pathlib.Path, help="Output directory for the linked sheets")
+    subparser_link.add_argument("--parent-column", required=False, default=None, help="Metadata column with the parent name. Default is sample_attribute[cryosection], or host subject id if there is none")
+
+    # Arguments for response lookup
+    subparser_lookup = subparsers.add_parser("lookup", help="Show the archived BioSamples responses of a sample")
+    subparser_lookup.add_argument("-o", "--output", required=True, type=pathlib.Path, help="Output directory of the biosample submission")
+    subparser_lookup.add_argument("-s", "--sample", required=True, help="Sample name or accession")
+    subparser_lookup.add_argument("-k", "--kind", required=False, choices=["sample", "structured_data", "error", "structured_error"], default=None, help="Only show responses of this kind")
+    subparser_lookup.add_argument("--all", required=False, action="store_true", help="Show all responses of the sample, oldest first, instead of only the latest")
 
     # Arguments for unlock
     subparser_unlock = subparsers.add_parser("unlock", help="Unlock output directory")
@@ -106,35 +149,68 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    if args.command in ["macrosample", "microsample"]:
+        from arch3d.utils import create_secret, create_checklists, preflight_check, report_preflight
+        if args.preflight:
+            report_preflight(preflight_check(args.metadata, args.data, args.workers))
+
     if args.command == "macrosample":
         input_dir = args.output / "input"
         input_dir.mkdir(parents=True, exist_ok=True)
-        create_secret(args.username, args.password, str(Path(args.output).resolve() / 'input' / '.secret.yml'))
-        create_data_dict(args.metadata, args.data, str(Path(args.output).resolve() / 'input' / 'input.json'))
-        create_run_checklists(args.metadata, str(Path(args.output).resolve() / 'checklists' / 'run'))
-        create_experiment_checklists(args.metadata, str(Path(args.output).resolve() / 'checklists' / 'experiment'))
-        create_sample_checklists(args.metadata, str(Path(args.output).resolve() / 'checklists' / 'sample'))
-        run_snakemake(args.command, Path(args.output).resolve(),args.connections, 'slurm')
+        create_secret(args.username, args.password, str(pathlib.Path(args.output).resolve() / 'input' / '.secret.yml'))
+        create_checklists(args.metadata, args.data, pathlib.Path(args.output).resolve(), microsample=False, workers=args.workers, checksums=not args.no_checksums, chunksize=args.chunksize)
+        if args.executor == "local":
+            from arch3d.executor import run_local
+            run_local(pathlib.Path(args.output).resolve(), args.connections, args.batch_size, args.username, False if args.no_registry else args.registry)
+        else:
+            run_snakemake(args.command, pathlib.Path(args.output).resolve(),args.connections, 'slurm', args.batch_size, args.username, False if args.no_registry else args.registry, not args.no_checksums)
 
     if args.command == "microsample":
+        if not args.no_spatial_check:
+            from arch3d.spatial import read_spatial_columns, spatial_check, report_spatial
+            report_spatial(spatial_check(read_spatial_columns(args.metadata, args.chunksize)))
         input_dir = args.output / "input"
         input_dir.mkdir(parents=True, exist_ok=True)
-        create_secret(args.username, args.password, str(Path(args.output).resolve() / 'input' / '.secret.yml'))
-        create_data_dict(args.metadata, args.data, str(Path(args.output).resolve() / 'input' / 'input.json'))
-        create_run_checklists(args.metadata, str(Path(args.output).resolve() / 'checklists' / 'run'))
-        create_experiment_checklists(args.metadata, str(Path(args.output).resolve() / 'checklists' / 'experiment'))
-        create_microsample_checklists(args.metadata, str(Path(args.output).resolve() / 'checklists' / 'sample'))
-        run_snakemake(args.command, Path(args.output).resolve(),args.connections, 'slurm')
+        create_secret(args.username, args.password, str(pathlib.Path(args.output).resolve() / 'input' / '.secret.yml'))
+        create_checklists(args.metadata, args.data, pathlib.Path(args.output).resolve(), microsample=True, workers=args.workers, checksums=not args.no_checksums, chunksize=args.chunksize)
+        if args.executor == "local":
+            from arch3d.executor import run_local
+            run_local(pathlib.Path(args.output).resolve(), args.connections, args.batch_size, args.username, False if args.no_registry else args.registry)
+        else:
+            run_snakemake(args.command, pathlib.Path(args.output).resolve(),args.connections, 'slurm', args.batch_size, args.username, False if args.no_registry else args.registry, not args.no_checksums)
 
     if args.command == "biosample":
-        process_biosample(args.input, args.output, args.username, args.password)
+        from arch3d.utils import set_ebi_url, process_biosample, process_biosample_hierarchy
+        if args.ebi_url:
+            set_ebi_url(args.ebi_url)
+        if len(args.input) == 1:
+            process_biosample(args.input[0], args.output, args.username, args.password, args.workers, args.resume, args.skip_unchanged, chunksize=args.chunksize, response_format=args.response_format, registry=False if args.no_registry else args.registry)
+        elif args.chunksize:
+            print("Error: --chunksize can only be used with a single input table, as related tables are linked as a whole.")
+            sys.exit(1)
+        else:
+            process_biosample_hierarchy(args.input, args.output, args.username, args.password, args.workers, args.resume, args.skip_unchanged, response_format=args.response_format, registry=False if args.no_registry else args.registry)
+
+    if args.command == "link":
+        from arch3d.link import link_sheets
+        link_sheets(args.receipts, args.metadata, args.input, args.output, args.parent_column)
+
+    if args.command == "lookup":
+        import json
+        from arch3d.responses import lookup_responses
+        records = lookup_responses(args.output / "responses", args.sample, args.kind)
+        if not records:
+            print(f"Error: No archived responses found for '{args.sample}'.")
+            sys.exit(1)
+        for record in (records if args.all else records[-1:]):
+            print(json.dumps(record, indent=2))
 
     ###
     # Unlock
     ###
 
     if args.command == "unlock":
-        unlock_snakemake(Path(args.output).resolve(), 'slurm')
+        unlock_snakemake(pathlib.Path(args.output).resolve(), 'slurm')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import shutil
+import importlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+######
+# Local execution of the upload workflow, without Snakemake, SLURM or environment modules
+######
+
+PACKAGE_DIR = Path(__file__).parent
+SCRIPTS_DIR = PACKAGE_DIR / "workflow" / "scripts"
+
+# ena-upload-cli call of the upload rules, shared with the Snakefile
+UPLOAD_COMMAND = ["ena-upload-cli", "--action", "add", "--center", "University of Copenhagen", "--checklist", "ERC000013"]
+CHECKLISTS = ["sample", "experiment", "run"]
+
+def load_script(name):
+    """Import one of the workflow scripts (split_receipt, merge_output, upload_metrics, timed) as a module."""
+    if str(SCRIPTS_DIR) not in sys.path:
+        sys.path.insert(0, str(SCRIPTS_DIR))
+    return importlib.import_module(name)
+
+def upload_jobs(output_dir: Path, batch_size: int = 1):
+    """Return the upload jobs of a prepared output directory, named and grouped as in the Snakefile.
+
+    Each job is a dictionary with its name, samples, data files, checklists and
+    upload directory, where ena-upload-cli writes receipt.xml.
+    """
+    with open(output_dir / "input" / "input.json", "r") as f:
+        sample_to_reads = json.load(f)
+    samples = list(sample_to_reads)
+
+    if batch_size <= 1:
+        return [
+            {
+                "name": sample,
+                "samples": [sample],
+                "data": sample_to_reads[sample],
+                "checklists": {checklist: output_dir / "checklists" / checklist / f"{sample}.tsv" for checklist in CHECKLISTS},
+                "outdir": output_dir / "output" / sample
+            }
+            for sample in samples
+        ]
+
+    jobs = []
+    for i in range(0, len(samples), batch_size):
+        batch = f"batch{i // batch_size + 1:05d}"
+        members = samples[i:i + batch_size]
+        jobs.append({
+            "name": batch,
+            "samples": members,
+            "data": [path for sample in members for path in sample_to_reads[sample]],
+            "checklists": {checklist: output_dir / "checklists" / "batch" / batch / f"{checklist}.tsv" for checklist in CHECKLISTS},
+            "outdir": output_dir / "output" / "batch" / batch
+        })
+    return jobs
+
+def out_of_date(job, output_dir: Path):
+    """Return True if a job has no receipt yet, or if a checklist of its samples changed after its upload.
+
+    Checklists are only rewritten when their content changes, as with the upload
+    rules of the Snakemake workflow.
+    """
+    receipt = job["outdir"] / "receipt.xml"
+    if not receipt.exists():
+        return True
+    uploaded = receipt.stat().st_mtime
+    return any(
+        (output_dir / "checklists" / checklist / f"{sample}.tsv").stat().st_mtime > uploaded
+        for sample in job["samples"] for checklist in CHECKLISTS
+    )
+
+def write_batch_checklist(paths, output_file):
+    """Concatenate per-sample checklists into a batch checklist, keeping a single header.
+
+    Also used by the batch_checklist rule of the Snakefile.
+    """
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    seen = set()
+    with open(output_file, "w") as out:
+        for i, path in enumerate(paths):
+            with open(path, "r") as f:
+                header = f.readline()
+                if i == 0:
+                    out.write(header)
+                for line in f:
+                    # Libraries of the same sample share one sample row
+                    if line not in seen:
+                        seen.add(line)
+                        out.write(line)
+
+def run_upload(job, secret: Path, log_file: Path, benchmark_file: Path):
+    """Run ena-upload-cli for one job, writing a Snakemake-style benchmark file.
+
+    Returns True if the upload succeeded and left a receipt.
+    """
+    os.makedirs(job["outdir"], exist_ok=True)
+    command = UPLOAD_COMMAND + [
+        "--sample", str(job["checklists"]["sample"]),
+        "--experiment", str(job["checklists"]["experiment"]),
+        "--run", str(job["checklists"]["run"]),
+        "--data", *job["data"],
+        "--secret", str(secret)
+    ]
+    with open(log_file, "w") as log:
+        returncode = load_script("timed").run_timed(command, benchmark_file, cwd=job["outdir"], stdout=log)
+
+    return returncode == 0 and os.path.exists(job["outdir"] / "receipt.xml")
+
+def run_local(output_dir, connections: int, batch_size: int = 1, webin: str = None, registry=None):
+    """Upload a prepared output directory with at most `connections` concurrent ena-upload-cli processes.
+
+    Produces the same output/{sample}/receipt.xml files, data_submission.tsv and upload
+    metrics as the Snakemake workflow. Jobs whose receipt is newer than their checklists
+    are skipped, so an interrupted run can be resumed, and no new uploads are started once one fails.
+    With a webin account, the uploaded samples are added to the sample registry
+    (registry is its path: None for the default, False to disable it).
+    """
+    if shutil.which("ena-upload-cli") is None:
+        print("Error: ena-upload-cli was not found in PATH. Install it in the current environment or use '--executor slurm'.")
+        sys.exit(1)
+
+    output_dir = Path(output_dir)
+    secret = output_dir / "input" / ".secret.yml"
+    log_dir = output_dir / "logs" / "upload"
+    benchmark_dir = output_dir / "benchmarks" / "upload"
+    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(benchmark_dir, exist_ok=True)
+
+    jobs = upload_jobs(output_dir, batch_size)
+    samples = [sample for job in jobs for sample in job["samples"]]
+    pending = [job for job in jobs if out_of_date(job, output_dir)]
+    print(f"Uploading {len(pending)} jobs ({len(jobs) - len(pending)} already uploaded and unchanged) with {connections} concurrent connections")
+
+    if batch_size > 1:
+        for job in pending:
+            for checklist in CHECKLISTS:
+                paths = [output_dir / "checklists" / checklist / f"{sample}.tsv" for sample in job["samples"]]
+                write_batch_checklist(paths, job["checklists"][checklist])
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+        futures = {
+            executor.submit(run_upload, job, secret, log_dir / f"{job['name']}.log", benchmark_dir / f"{job['name']}.tsv"): job
+            for job in pending
+        }
+        done = 0
+        for future in as_completed(futures):
+            job = futures[future]
+            if future.cancelled():
+                continue
+            done += 1
+            if future.result():
+                print(f"Uploaded {job['name']} ({done}/{len(pending)})")
+            else:
+                if not failed:
+                    # Let running uploads finish, but do not start new ones
+                    for other in futures:
+                        other.cancel()
+                failed.append(job["name"])
+                print(f"Upload of {job['name']} failed, see {log_dir / (job['name'] + '.log')}")
+
+    if failed:
+        print(f"Error: {len(failed)} uploads failed. Fix the problem and run the same command again to upload the remaining samples.")
+        sys.exit(1)
+
+    # Split batch receipts into per-sample receipts, again for batches uploaded since
+    # the last split, as the split_receipt rule does
+    if batch_size > 1:
+        split_receipt = load_script("split_receipt")
+        for job in jobs:
+            uploaded = (job["outdir"] / "receipt.xml").stat().st_mtime
+            for sample in job["samples"]:
+                receipt = output_dir / "output" / sample / "receipt.xml"
+                if not receipt.exists() or receipt.stat().st_mtime < uploaded:
+                    os.makedirs(receipt.parent, exist_ok=True)
+                    sample_alias = split_receipt.get_sample_alias(output_dir / "checklists" / "experiment" / f"{sample}.tsv")
+                    tree = split_receipt.split_receipt(job["outdir"] / "receipt.xml", sample, sample_alias)
+                    tree.write(receipt, encoding="UTF-8", xml_declaration=True)
+
+    # Merge receipts, writing the same manifest as the merge_output rule
+    receipts = [str(output_dir / "output" / sample / "receipt.xml") for sample in samples]
+    with open(output_dir / "output" / "receipts.txt", "w") as f:
+        f.writelines(f"{receipt}\n" for receipt in receipts)
+    merge_output = load_script("merge_output")
+    merge_output.merge(receipts, str(output_dir / "data_submission.tsv"), str(output_dir / ".merge_output"), min(4, max(1, connections)))
+    if webin and registry is not False:
+        merge_output.register_samples(str(output_dir / "data_submission.tsv"), webin, registry)
+
+    # Upload metrics of the jobs that have a benchmark file
+    jobs_info = {
+        job["name"]: {"benchmark": str(benchmark_dir / f"{job['name']}.tsv"), "data": job["data"]}
+        for job in jobs if (benchmark_dir / f"{job['name']}.tsv").exists()
+    }
+    os.makedirs(output_dir / "metrics", exist_ok=True)
+    with open(output_dir / "metrics" / "upload_jobs.json", "w") as f:
+        json.dump(jobs_info, f)
+    load_script("upload_metrics").write_upload_metrics(jobs_info, str(output_dir / "metrics"))
+    print(f"Submission table saved: {output_dir / 'data_submission.tsv'}")
@@ -0,0 +1,144 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+######
+# Linking of ENA receipt samples to their parents in BioSample sheets
+######
+
+# Metadata columns naming the parent of a sample, in order of preference
+PARENT_COLUMNS = ['sample_attribute[cryosection]', 'host subject id']
+MAX_REPORTED = 20  # Unmatched keys printed per kind
+
+def read_receipts(paths):
+    """Return the sample alias and BioSample accession of every sample in data_submission.tsv tables.
+
+    Samples whose upload failed (N/A) are left out.
+    """
+    df = pd.concat(
+        [pd.read_csv(path, sep="\t", usecols=["sample", "biosample_accession"], dtype=str, keep_default_na=False) for path in paths],
+        ignore_index=True
+    )
+    df = df[(df["sample"] != "N/A") & (df["biosample_accession"] != "N/A") & (df["biosample_accession"] != "")]
+    return df.drop_duplicates()
+
+def read_parents(paths, parent_column=None):
+    """Return the parent of every sample alias in the metadata tables used for the ENA upload.
+
+    The parent is read from parent_column, or from the first of PARENT_COLUMNS found
+    in each table (matched case-insensitively): the cryosection of microsamples, the
+    animal of macrosamples.
+    """
+    tables = []
+    for path in paths:
+        columns = {column.lower(): column for column in pd.read_csv(path, sep=",", nrows=0).columns}
+        candidates = [parent_column.lower()] if parent_column else PARENT_COLUMNS
+        found = [columns[column] for column in candidates if column in columns]
+        if "sample_alias" not in columns or not found:
+            print(f"Error: The metadata table '{path}' needs a sample_alias column and one of: {', '.join(candidates)}.")
+            sys.exit(1)
+        df = pd.read_csv(path, sep=",", usecols=[columns["sample_alias"], found[0]], dtype=str, keep_default_na=False)
+        tables.append(df.set_axis(["sample", "parent"], axis=1))
+    df = pd.concat(tables, ignore_index=True)
+    df["parent"] = df["parent"].str.strip()
+    # Libraries of the same sample share one row
+    return df[df["parent"] != ""].drop_duplicates()
+
+def split_children(sheet):
+    """Return the (name, child) pairs already listed in the child_samples column of a sheet."""
+    if "child_samples" not in sheet.columns:
+        return pd.DataFrame({"name": pd.Series(dtype=str), "child": pd.Series(dtype=str)})
+    children = sheet[["name", "child_samples"]].set_axis(["name", "child"], axis=1)
+    children = children.assign(child=children["child"].str.split(",")).explode("child")
+    children["child"] = children["child"].str.strip()
+    return children[children["child"].notna() & (children["child"] != "")]
+
+def join_children(children):
+    """Join the children of every name with commas, in their order of appearance."""
+    codes, names = pd.factorize(children["name"])
+    order = np.argsort(codes, kind="stable")
+    values = children["child"].to_numpy(dtype=object)[order].tolist()
+    ends = np.cumsum(np.bincount(codes, minlength=len(names)))
+    starts = ends - np.bincount(codes, minlength=len(names))
+    return pd.Series([",".join(values[start:end]) for start, end in zip(starts.tolist(), ends.tolist())], index=names, dtype=object)
+
+def link_children(receipts, parents, sheets):
+    """Add the BioSample accessions of the receipt samples to the child_samples of their parents.
+
+    receipts has sample and biosample_accession columns, parents has sample and
+    parent columns, and sheets are BioSample sheets whose name matches the parents.
+    Children already listed are kept, and every child is listed once. Returns the
+    linked sheets and the unmatched keys, as a DataFrame of kind and key.
+    """
+    names = pd.concat([sheet["name"] for sheet in sheets], ignore_index=True)
+    duplicated = names[names.duplicated()].unique()
+    if len(duplicated):
+        print(f"Error: Sample names appear more than once in the input sheets: {', '.join(duplicated[:MAX_REPORTED])}")
+        sys.exit(1)
+
+    # Samples listed under different parents cannot be placed
+    conflicting = parents.loc[parents["sample"].duplicated(keep=False), "sample"].unique()
+    parents = parents[~parents["sample"].isin(conflicting)]
+    conflicting = conflicting[pd.Series(conflicting, dtype=str).isin(receipts["sample"]).to_numpy()]
+
+    links = receipts.merge(parents, on="sample", how="left")
+    without_parent = links.loc[links["parent"].isna() & ~links["sample"].isin(conflicting), "sample"].unique()
+    links = links.dropna(subset=["parent"])
+    unknown_parents = links.loc[~links["parent"].isin(names), "parent"].unique()
+    new_children = links[["parent", "biosample_accession"]].set_axis(["name", "child"], axis=1)
+
+    linked = []
+    childless = []
+    for sheet in sheets:
+        children = pd.concat([split_children(sheet), new_children[new_children["name"].isin(sheet["name"])]], ignore_index=True)
+        children = join_children(children.drop_duplicates())
+        sheet = sheet.copy()
+        if "child_samples" not in sheet.columns:
+            position = sheet.columns.get_loc("accession") if "accession" in sheet.columns else len(sheet.columns)
+            sheet.insert(position, "child_samples", "")
+        sheet["child_samples"] = sheet["name"].map(children).fillna("")
+        childless += sheet.loc[sheet["child_samples"] == "", "name"].tolist()
+        linked.append(sheet)
+
+    unmatched = pd.concat([
+        pd.DataFrame({"kind": "sample_without_parent", "key": without_parent}),
+        pd.DataFrame({"kind": "sample_with_several_parents", "key": conflicting}),
+        pd.DataFrame({"kind": "parent_not_in_sheets", "key": unknown_parents}),
+        pd.DataFrame({"kind": "sheet_row_without_children", "key": childless}),
+    ], ignore_index=True)
+    return linked, unmatched
+
+def link_sheets(receipt_tables, metadata_tables, input_sheets, output_dir, parent_column=None):
+    """Write copies of BioSample sheets with child_samples filled from ENA receipt tables.
+
+    The sheets are written as {output_dir}/linked_{sheet}, ready for arch3d biosample,
+    and the unmatched keys to {output_dir}/unmatched.tsv.
+    """
+    for path in list(receipt_tables) + list(metadata_tables) + list(input_sheets):
+        if not os.path.exists(path):
+            print(f"Error: The input file '{path}' does not exist.")
+            sys.exit(1)
+    output_dir = Path(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    receipts = read_receipts(receipt_tables)
+    parents = read_parents(metadata_tables, parent_column)
+    sheets = [pd.read_csv(path, sep=",", dtype=str, keep_default_na=False) for path in input_sheets]
+    linked, unmatched = link_children(receipts, parents, sheets)
+
+    for path, sheet in zip(input_sheets, linked):
+        linked_path = output_dir / f"linked_{os.path.basename(path)}"
+        sheet.to_csv(linked_path, sep=",", index=False)
+        print(f"Linked sheet saved: {linked_path} ({(sheet['child_samples'] != '').sum()} of {len(sheet)} samples with children)")
+
+    unmatched_path = output_dir / "unmatched.tsv"
+    unmatched.to_csv(unmatched_path, sep="\t", index=False)
+    print(f"Receipt samples read: {len(receipts)}")
+    for kind, keys in unmatched.groupby("kind", sort=False)["key"]:
+        shown = ", ".join(keys.astype(str).head(MAX_REPORTED))
+        more = f" and {len(keys) - MAX_REPORTED} more" if len(keys) > MAX_REPORTED else ""
+        print(f"    {kind.replace('_', ' ').capitalize()}: {len(keys)} ({shown}{more})")
+    print(f"Unmatched keys saved: {unmatched_path}")
+    return linked, unmatched
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+######
+# Run metrics: timing spans, counters and their JSON/Prometheus reports
+######
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600, 14400)
+
+class Histogram:
+    """Cumulative-bucket histogram of durations, as exported by Prometheus."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket that contains it."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, cumulative in zip(BUCKETS, self.buckets):
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": {str(bound): cumulative for bound, cumulative in zip(BUCKETS, self.buckets)},
+        }
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Metrics:
+    """Thread-safe registry of timing spans and counters for one run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.spans = {}
+        self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block under the given span name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.spans.setdefault(name, Histogram()).observe(seconds)
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        """Return a counter, summed over all labels not given."""
+        with self.lock:
+            return sum(
+                value for (counter, counter_labels), value in self.counters.items()
+                if counter == name and all(dict(counter_labels).get(key) == val for key, val in labels.items())
+            )
+
+    def summary(self, throughput=None):
+        duration = time.time() - self.started
+        with self.lock:
+            summary = {
+                "started": self.started,
+                "duration_seconds": duration,
+                "spans": {name: histogram.summary() for name, histogram in sorted(self.spans.items())},
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+            }
+        # Throughput of the whole run, per counted unit (e.g. rows, bytes)
+        summary["throughput"] = {
+            f"{unit}_per_second": amount / duration if duration > 0 else None
+            for unit, amount in (throughput or {}).items()
+        }
+        return summary
+
+    def prometheus(self, summary):
+        """Render a summary in the Prometheus textfile exposition format."""
+        lines = []
+        lines.append("# HELP arch3d_span_seconds Duration of instrumented operations.")
+        lines.append("# TYPE arch3d_span_seconds histogram")
+        for name, span in summary["spans"].items():
+            for bound, cumulative in span["buckets"].items():
+                lines.append(f'arch3d_span_seconds_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'arch3d_span_seconds_bucket{{span="{name}",le="+Inf"}} {span["count"]}')
+            lines.append(f'arch3d_span_seconds_sum{{span="{name}"}} {span["sum"]}')
+            lines.append(f'arch3d_span_seconds_count{{span="{name}"}} {span["count"]}')
+        names = sorted({counter["name"] for counter in summary["counters"]})
+        for name in names:
+            lines.append(f"# TYPE arch3d_{name}_total counter")
+            for counter in summary["counters"]:
+                if counter["name"] == name:
+                    lines.append(f"arch3d_{name}_total{format_labels(sorted(counter['labels'].items()))} {counter['value']}")
+        lines.append("# TYPE arch3d_run_duration_seconds gauge")
+        lines.append(f"arch3d_run_duration_seconds {summary['duration_seconds']}")
+        for name, value in summary["throughput"].items():
+            if value is not None:
+                lines.append(f"# TYPE arch3d_{name} gauge")
+                lines.append(f"arch3d_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, output_dir, name="metrics", throughput=None):
+        """Write {name}.json and {name}.prom to output_dir, returning the summary."""
+        os.makedirs(output_dir, exist_ok=True)
+        summary = self.summary(throughput)
+        json_path = os.path.join(output_dir, f"{name}.json")
+        prom_path = os.path.join(output_dir, f"{name}.prom")
+        with open(json_path, "w") as f:
+            json.dump(summary, f, indent=2)
+        # Write to a temporary file first so textfile collectors never see partial files
+        with open(f"{prom_path}.tmp", "w") as f:
+            f.write(self.prometheus(summary))
+        os.replace(f"{prom_path}.tmp", prom_path)
+        print(f"Metrics saved: {json_path}")
+        return summary
+
+METRICS = Metrics()
@@ -0,0 +1,248 @@
+import re
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import itertools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+######
+# Local stand-in for the Webin authentication, BioSamples and structured data APIs
+######
+
+SAMPLE_PATH = re.compile(r"^/biosamples/samples/([^/?]+)$")
+STRUCTUREDDATA_PATH = re.compile(r"^/biosamples/structureddata/([^/?]+)$")
+
+def make_token(username, lifetime):
+    """Create an unsigned JWT-like token carrying its expiry, as Webin tokens do."""
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+    header = encode({"alg": "none", "typ": "JWT"})
+    payload = encode({"sub": username, "exp": int(time.time() + lifetime)})
+    return f"{header}.{payload}.mock"
+
+def token_expired(token):
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))["exp"] < time.time()
+    except (IndexError, KeyError, ValueError):
+        return True
+
+class MockEBIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections alive like the real service
+    disable_nagle_algorithm = True  # Headers and body are written separately
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, content_type="application/json", headers=None):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            return None
+
+    def simulate(self):
+        """Apply latency and injected failures. Returns True if the request was answered with a failure."""
+        server = self.server
+        if not server.enter():
+            server.count("429")
+            self.send_json(429, {"error": "Too Many Requests"}, headers={"Retry-After": str(server.retry_after)})
+            return True
+        try:
+            server.wait()
+        finally:
+            server.leave()
+        roll = server.random()
+        if roll < server.throttle_rate:
+            server.count("429")
+            self.send_json(429, {"error": "Too Many Requests"}, headers={"Retry-After": str(server.retry_after)})
+            return True
+        if roll < server.throttle_rate + server.error_rate:
+            server.count("500")
+            self.send_json(500, {"error": "Internal Server Error"})
+            return True
+        return False
+
+    def authorized(self):
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer ") or token_expired(authorization[len("Bearer "):]):
+            self.server.count("401")
+            self.send_json(401, {"error": "Unauthorized"})
+            return False
+        return True
+
+    def do_POST(self):
+        body = self.read_json()
+        if self.simulate():
+            return
+        if self.path == "/ena/submit/webin/auth/token":
+            if not body or not body.get("username") or not body.get("password"):
+                self.server.count("401")
+                return self.send_json(401, "Invalid credentials", "text/plain")
+            self.server.count("auth")
+            return self.send_json(200, make_token(body["username"], self.server.token_lifetime), "text/plain")
+        if self.path == "/biosamples/samples":
+            if not self.authorized():
+                return
+            if not body or "name" not in body:
+                self.server.count("400")
+                return self.send_json(400, {"error": "Invalid sample"})
+            body["accession"] = self.server.new_accession()
+            self.server.store(body["accession"], body)
+            self.server.count("201")
+            return self.send_json(201, body)
+        self.send_json(404, {"error": "Not Found"})
+
+    def do_PUT(self):
+        body = self.read_json()
+        if self.simulate():
+            return
+        if not self.authorized():
+            return
+        match = SAMPLE_PATH.match(self.path)
+        if match:
+            if not body or body.get("accession") != match.group(1):
+                self.server.count("400")
+                return self.send_json(400, {"error": "Accession does not match"})
+            self.server.store(match.group(1), body)
+            self.server.count("200")
+            return self.send_json(200, body)
+        match = STRUCTUREDDATA_PATH.match(self.path)
+        if match:
+            self.server.store(f"structureddata/{match.group(1)}", body)
+            self.server.count("200")
+            return self.send_json(200, body)
+        self.send_json(404, {"error": "Not Found"})
+
+    def do_GET(self):
+        if self.simulate():
+            return
+        match = SAMPLE_PATH.match(self.path)
+        key = match.group(1) if match else None
+        match = STRUCTUREDDATA_PATH.match(self.path)
+        if match:
+            key = f"structureddata/{match.group(1)}"
+        record = self.server.records.get(key) if key else None
+        if record is None:
+            return self.send_json(404, {"error": "Not Found"})
+        self.server.count("200")
+        self.send_json(200, record)
+
+class MockEBIServer(ThreadingHTTPServer):
+    """Threaded mock of the EBI endpoints used by arch3d.
+
+    Hands out accessions, keeps submitted records in memory and can add latency
+    (seconds, plus uniform jitter), random 500 errors and 429 responses with a
+    Retry-After header. With a capacity, requests beyond that many in flight are
+    answered with 429 too. Use start() to serve from a background thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1, token_lifetime=3600, seed=None, verbose=False, capacity=None):
+        super().__init__(address, MockEBIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.token_lifetime = token_lifetime
+        self.capacity = capacity
+        self.in_flight = 0
+        self.verbose = verbose
+        self.records = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.accessions = itertools.count(1)
+        self.rng = random.Random(seed)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def wait(self):
+        if self.latency or self.jitter:
+            with self.lock:
+                delay = self.latency + self.rng.uniform(0, self.jitter)
+            time.sleep(delay)
+
+    def enter(self):
+        """Admit a request, unless the service is at capacity."""
+        with self.lock:
+            if self.capacity and self.in_flight >= self.capacity:
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def new_accession(self):
+        with self.lock:
+            return f"SAMEA9{next(self.accessions):08d}"
+
+    def store(self, key, record):
+        with self.lock:
+            self.records[key] = record
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the EBI Webin authentication and BioSamples APIs")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on. Default is 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on. Default is 8080")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency added to every request, in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random latency added on top, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After (seconds) sent with 429 responses")
+    parser.add_argument("--capacity", type=int, default=None, help="Requests served concurrently; further ones are answered with 429. Default is unlimited")
+    parser.add_argument("--token-lifetime", type=int, default=3600, help="Lifetime of issued tokens, in seconds")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for injected failures")
+    args = parser.parse_args()
+
+    server = MockEBIServer((args.host, args.port), args.latency / 1000, args.jitter / 1000, args.error_rate,
+                           args.throttle_rate, args.retry_after, args.token_lifetime, args.seed, verbose=True,
+                           capacity=args.capacity)
+    print(f"Mock EBI service listening on {server.url} (use: arch3d biosample --ebi-url {server.url} ...)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)
+
+if __name__ == "__main__":
+    main()
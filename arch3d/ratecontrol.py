@@ -0,0 +1,147 @@
+import time
+import random
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+######
+# Adaptive concurrency and rate control of API requests, with a retry budget
+######
+
+THROTTLE_STATUSES = {429, 503}           # The service asks clients to slow down
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Additive increase, multiplicative decrease
+DECREASE = 0.5         # Factor applied to concurrency and rate on congestion
+LATENCY_FACTOR = 3     # Latency above this multiple of the baseline counts as congestion
+MIN_RATE = 0.2         # Requests per second never go below this
+RATE_RECOVERY = 0.25   # Fraction of the rate regained per second after a decrease
+RATE_WINDOW = 5        # Seconds over which the achieved request rate is measured
+
+# Retries
+MAX_ATTEMPTS = 6       # Attempts of a single request, including the first one
+BACKOFF_BASE = 0.5     # Seconds; the backoff ceiling doubles with every attempt
+BACKOFF_CAP = 60
+MAX_RETRY_AFTER = 300  # Longer Retry-After values are capped
+RETRY_BUDGET = 20      # Retries allowed per run, plus RETRY_RATIO per request sent
+RETRY_RATIO = 0.1
+
+def retry_after(response):
+    """Return the Retry-After of a response in seconds (given as seconds or as an HTTP date), or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+class RateController:
+    """Shared limit on the concurrency and rate of requests to a service.
+
+    Every request waits for a free slot (at most `limit` in flight) and for its turn
+    at the current rate. Successful requests raise the concurrency limit by about
+    one per round trip and the rate by a fixed step per second (a quarter of the rate
+    at the last decrease); 429/503 responses halve both, and latency well above the
+    lowest one seen halves the concurrency, at most once per round trip.
+    Retries are drawn from a budget that grows with the number of requests sent,
+    so a failing service is not flooded with retries.
+    """
+
+    def __init__(self, max_concurrency=1):
+        self.condition = threading.Condition()
+        self.reset(max_concurrency)
+
+    def reset(self, max_concurrency=1):
+        with self.condition:
+            self.max_concurrency = max(1, max_concurrency)
+            self.limit = float(self.max_concurrency)
+            self.rate = None  # Unlimited until the service throttles us
+            self.rate_step = 1.0
+            self.in_flight = 0
+            self.next_start = 0.0
+            self.decreased_at = 0.0
+            self.baseline = None
+            self.starts = deque()
+            self.requests = 0
+            self.retries = 0
+
+    def acquire(self):
+        """Wait for a free slot and for the next start time allowed by the rate."""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            now = time.monotonic()
+            self.in_flight += 1
+            self.requests += 1
+            start = now
+            if self.rate:
+                start = max(now, self.next_start)
+                self.next_start = start + 1 / self.rate
+            self.starts.append(start)
+            self._forget(now)
+        delay = start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self, latency, status=None):
+        """Free a slot and adapt the limits to the latency and status of the finished request."""
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if status in THROTTLE_STATUSES:
+                self._decrease(now, rate=True)
+            elif status is not None and self.baseline and latency > LATENCY_FACTOR * self.baseline:
+                self._decrease(now, rate=False)
+            elif status is not None and status < 500:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                if self.rate:
+                    self.rate += self.rate_step / self.rate
+            if status is not None and status < 500:
+                # Lowest latency seen, slowly forgotten so it follows the service
+                self.baseline = latency if self.baseline is None else min(latency, self.baseline * 1.01)
+            self.condition.notify_all()
+
+    def _decrease(self, now, rate):
+        # Requests in flight saw the same congestion, so react once per round trip
+        if now - self.decreased_at < max(self.baseline or 0, 1.0):
+            return
+        self.decreased_at = now
+        self.limit = max(1.0, self.limit * DECREASE)
+        if rate:
+            self.rate_step = max(MIN_RATE, RATE_RECOVERY * (self.rate or self._achieved_rate(now)))
+            self.rate = max(MIN_RATE, (self.rate or self._achieved_rate(now)) * DECREASE)
+            self.next_start = now + 1 / self.rate
+
+    def _forget(self, now):
+        # Only the starts of the last RATE_WINDOW seconds are kept, so memory stays flat
+        while self.starts and self.starts[0] < now - RATE_WINDOW:
+            self.starts.popleft()
+
+    def _achieved_rate(self, now):
+        self._forget(now)
+        if len(self.starts) < 2:
+            return MIN_RATE
+        return max(MIN_RATE, len(self.starts) / max(now - self.starts[0], 0.1))
+
+    def retry(self, attempt, wait=None):
+        """Decide whether a failed request is retried, and wait for its backoff if so.
+
+        attempt is the number of attempts made so far; wait is the Retry-After of
+        the response, the least time to wait before the retry.
+        """
+        with self.condition:
+            if attempt >= MAX_ATTEMPTS or self.retries >= RETRY_BUDGET + RETRY_RATIO * self.requests:
+                return False
+            self.retries += 1
+        # Full jitter spreads out the retries of requests that failed together
+        time.sleep(max(wait or 0, random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))))
+        return True
+
+    def state(self):
+        with self.condition:
+            return {"concurrency": self.limit, "rate": self.rate, "requests": self.requests, "retries": self.retries}
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime
+
+######
+# Local registry of sample names and their accessions
+######
+
+REGISTRY_PATH = Path(os.environ.get("XDG_DATA_HOME", Path.home() / ".local" / "share")) / "arch3d" / "registry.sqlite"
+
+# Endpoint of the production EBI services, where ena-upload-cli submits
+DEFAULT_ENDPOINT = "https://www.ebi.ac.uk"
+
+def registry_path():
+    return Path(os.environ.get("ARCH3D_REGISTRY", REGISTRY_PATH))
+
+class SampleRegistry:
+    """SQLite index of the accession of every sample name, per EBI endpoint and Webin account.
+
+    Filled with the BioSamples created or updated by arch3d and with the samples of
+    ENA receipts, so a sample can be found by name before it is created again. Each
+    entry also keeps the hash of the last payload sent and its source ("biosample" or
+    "ena"). Samples submitted to another endpoint (e.g. a mock server) are never
+    returned. Safe to share between threads and between concurrent arch3d runs.
+    """
+
+    def __init__(self, path=None, endpoint=DEFAULT_ENDPOINT):
+        self.path = Path(path or registry_path())
+        self.endpoint = endpoint.rstrip("/")
+        os.makedirs(self.path.parent, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(self.path), timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(samples)")]
+            if columns and "endpoint" not in columns:
+                # Entries of registries without endpoints cannot be told apart: set them aside
+                self.connection.execute("ALTER TABLE samples RENAME TO samples_without_endpoint")
+                self.connection.execute("DROP INDEX IF EXISTS samples_accession")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS samples ("
+                " endpoint TEXT NOT NULL,"
+                " webin TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " accession TEXT NOT NULL,"
+                " hash TEXT,"
+                " source TEXT,"
+                " updated TEXT,"
+                " PRIMARY KEY (endpoint, webin, name))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS samples_accession ON samples (accession)")
+
+    def lookup(self, webin, name):
+        """Return the accession registered for a sample name, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT accession FROM samples WHERE endpoint = ? AND webin = ? AND name = ?", (self.endpoint, str(webin), str(name))
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(self, webin, name, accession, hash=None, source="biosample"):
+        self.record_many([(webin, name, accession, hash, source)])
+
+    def record_many(self, entries):
+        """Register (webin, name, accession, hash, source) entries, replacing earlier accessions of the same names."""
+        updated = datetime.now().isoformat(timespec="seconds")
+        rows = [(self.endpoint, str(webin), str(name), str(accession), hash, source, updated) for webin, name, accession, hash, source in entries]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO samples (endpoint, webin, name, accession, hash, source, updated) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (endpoint, webin, name) DO UPDATE SET"
+                " accession = excluded.accession,"
+                " hash = COALESCE(excluded.hash, samples.hash),"
+                " source = excluded.source,"
+                " updated = excluded.updated",
+                rows
+            )
+        return len(rows)
+
+    def close(self):
+        self.connection.close()
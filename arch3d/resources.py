@@ -0,0 +1,107 @@
+import os
+import json
+from pathlib import Path
+
+######
+# Resource requests of upload jobs, learned from the benchmarks of earlier runs
+######
+
+HISTORY_PATH = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "arch3d" / "upload_history.jsonl"
+HISTORY_SIZE = 2000  # Most recent jobs used for fitting
+MIN_JOBS = 5         # Jobs needed before the history is trusted
+MARGIN = 1.25        # Safety factor on top of the largest observed deviation
+EXTRAPOLATION = 2    # Fits are only trusted up to this multiple of the largest recorded input
+
+# Floors of learned requests, and the static model used without history
+MIN_MEM_MB = 2 * 1024
+MIN_RUNTIME = 10
+STATIC_MEM_MB = 8 * 1024
+STATIC_MB_PER_MINUTE = 20
+
+def history_path():
+    return Path(os.environ.get("ARCH3D_RESOURCE_HISTORY", HISTORY_PATH))
+
+def read_history(path=None):
+    """Return the recorded upload jobs, oldest first (partially written lines are skipped)."""
+    path = path or history_path()
+    records = []
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+def append_history(records, path=None):
+    """Append upload job records {id, size_mb, seconds, max_rss_mb}, skipping ids already recorded."""
+    path = path or history_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    history = read_history(path)
+    known = {record.get("id") for record in history}
+    new = [record for record in records if record["id"] not in known]
+    if len(history) + len(new) > 2 * HISTORY_SIZE:
+        # Keep the file bounded, rewriting it with the most recent jobs only
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(json.dumps(record) + "\n" for record in (history + new)[-HISTORY_SIZE:])
+        os.replace(tmp_path, path)
+    elif new:
+        with open(path, "a") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in new))
+    return len(new)
+
+def fit_linear(points):
+    """Least-squares fit of y = intercept + slope * x (slope kept non-negative).
+
+    Returns the intercept, the slope, the largest amount by which a point
+    exceeds the fitted line and the largest x.
+    """
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    slope = max(0.0, sxy / sxx) if sxx > 0 else 0.0
+    intercept = mean_y - slope * mean_x
+    excess = max(0.0, max(y - (intercept + slope * x) for x, y in points))
+    return intercept, slope, excess, max(x for x, _ in points)
+
+class UploadResources:
+    """Predicts the memory (MB) and runtime (minutes) of upload jobs from their input size.
+
+    Memory and runtime are each fitted as a linear function of the input size over
+    the most recent recorded jobs, then raised by the largest deviation seen and a
+    safety margin. With fewer than MIN_JOBS usable jobs, or for inputs much larger
+    than any recorded one, a static model is used instead: a flat 8 GB and 20 MB
+    per minute, as uploads are network-bound. Both double on every retry.
+    """
+
+    def __init__(self, history=None):
+        history = read_history() if history is None else history
+        history = history[-HISTORY_SIZE:]
+        memory = [(r["size_mb"], r["max_rss_mb"]) for r in history if r.get("max_rss_mb") is not None]
+        runtime = [(r["size_mb"], r["seconds"] / 60) for r in history if r.get("seconds") is not None]
+        self.memory = fit_linear(memory) if len(memory) >= MIN_JOBS else None
+        self.runtime = fit_linear(runtime) if len(runtime) >= MIN_JOBS else None
+
+    @staticmethod
+    def predict(model, size_mb):
+        """Return the prediction of a fitted model, or None where it cannot be trusted."""
+        if model is None:
+            return None
+        intercept, slope, excess, max_size_mb = model
+        if size_mb > EXTRAPOLATION * max_size_mb:
+            return None
+        return (intercept + slope * size_mb + excess) * MARGIN
+
+    def mem_mb(self, size_mb, attempt=1):
+        mem_mb = self.predict(self.memory, size_mb)
+        mem_mb = STATIC_MEM_MB if mem_mb is None else max(MIN_MEM_MB, mem_mb)
+        return int(mem_mb * 2 ** (attempt - 1))
+
+    def runtime_minutes(self, size_mb, attempt=1):
+        runtime = self.predict(self.runtime, size_mb)
+        runtime = size_mb / STATIC_MB_PER_MINUTE if runtime is None else runtime
+        return int(max(MIN_RUNTIME, runtime) * 2 ** (attempt - 1))
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import gzip
+import threading
+from pathlib import Path
+from datetime import datetime
+
+######
+# BioSample API responses: one JSON file each, or a compressed archive with an index
+######
+
+def save_json(data, output_dir, filename):
+    """Save JSON data to a file."""
+    filepath = os.path.join(output_dir, filename)
+    with open(filepath, "w") as f:
+        json.dump(data, f, indent=2)
+    print(f"    Saved: {filepath}")
+
+class JsonResponseStore:
+    """Saves every response as an indented JSON file of its own, named after the sample and the time."""
+
+    SUFFIXES = {"sample": "", "error": "", "structured_data": "_data", "structured_error": "_structured_error"}
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, name, kind, data, accession=None):
+        timestamp = datetime.now().strftime("%Y%m%d%H%M")
+        save_json(data, self.directory, f"{name}{self.SUFFIXES[kind]}_{timestamp}.json")
+
+    def close(self):
+        pass
+
+class ResponseArchive:
+    """Append-only archive of responses in gzip-compressed JSON Lines shards.
+
+    Every record {time, name, accession, kind, response} is written as a separate gzip
+    member, so shards can be read whole with zcat and any record can be decompressed on
+    its own. index.jsonl lists the name, accession, kind, shard, offset and length of
+    every record, and an entry is only written once its record is complete. When the
+    archive is opened, anything written after the last indexed record (e.g. by a killed
+    run) is discarded, so the archive and its index always agree.
+    """
+
+    SHARD_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, directory, shard_size=SHARD_SIZE):
+        self.directory = Path(directory)
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_path = self.directory / "index.jsonl"
+        last = self.repair_index(self.index_path)
+        if last:
+            self.shard_number = int(last["shard"].split("-")[1].split(".")[0])
+            self.offset = last["offset"] + last["length"]
+        else:
+            self.shard_number = 0
+            self.offset = 0
+        self.shard = self.open_shard(truncate=True)
+        self.index = open(self.index_path, "a")
+
+    @staticmethod
+    def shard_name(number):
+        return f"responses-{number:05d}.jsonl.gz"
+
+    @staticmethod
+    def repair_index(index_path):
+        """Drop a partially written last line from the index and return its last entry."""
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - 65536))
+            tail = f.read()
+            if tail and not tail.endswith(b"\n"):
+                f.truncate(size - len(tail) + tail.rfind(b"\n") + 1)
+                tail = tail[:tail.rfind(b"\n") + 1]
+        lines = tail.splitlines()
+        return json.loads(lines[-1]) if lines else None
+
+    def open_shard(self, truncate=False):
+        path = self.directory / self.shard_name(self.shard_number)
+        shard = open(path, "ab")
+        if truncate and shard.tell() > self.offset:
+            shard.truncate(self.offset)
+        return shard
+
+    def save(self, name, kind, data, accession=None):
+        record = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "name": name,
+            "accession": accession,
+            "kind": kind,
+            "response": data
+        }
+        member = gzip.compress((json.dumps(record) + "\n").encode())
+        with self.lock:
+            if self.offset and self.offset + len(member) > self.shard_size:
+                self.shard.close()
+                self.shard_number += 1
+                self.offset = 0
+                self.shard = self.open_shard()
+            self.shard.write(member)
+            self.shard.flush()
+            entry = {
+                "name": name,
+                "accession": accession,
+                "kind": kind,
+                "shard": self.shard_name(self.shard_number),
+                "offset": self.offset,
+                "length": len(member)
+            }
+            self.index.write(json.dumps(entry) + "\n")
+            self.index.flush()
+            self.offset += len(member)
+
+    def close(self):
+        self.shard.close()
+        self.index.close()
+
+def open_response_store(output_dir, response_format="archive"):
+    """Open the store for API responses: a compressed archive, or one JSON file per response."""
+    if response_format == "json":
+        return JsonResponseStore(output_dir / "json")
+    return ResponseArchive(output_dir / "responses")
+
+def lookup_responses(archive_dir, sample, kind=None):
+    """Return the archived records of a sample, given by name or accession, oldest first."""
+    archive_dir = Path(archive_dir)
+    index_path = archive_dir / "index.jsonl"
+    if not index_path.exists():
+        print(f"Error: No response archive found in '{archive_dir}'.")
+        sys.exit(1)
+    # The index is written with json.dumps, which escapes quotes and non-ASCII characters
+    escaped = json.dumps(sample)[1:-1]
+    records = []
+    with open(index_path, "r") as f:
+        for line in f:
+            if escaped not in line:
+                continue  # Cheap filter before parsing
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if sample not in (entry["name"], entry["accession"]) or (kind and entry["kind"] != kind):
+                continue
+            with open(archive_dir / entry["shard"], "rb") as shard:
+                shard.seek(entry["offset"])
+                records.append(json.loads(gzip.decompress(shard.read(entry["length"]))))
+    return records
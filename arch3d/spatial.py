@@ -0,0 +1,237 @@
+import sys
+import numpy as np
+import pandas as pd
+from arch3d.utils import read_metadata
+
+######
+# Spatial validation of microsample coordinates
+######
+
+# Metadata columns (matched case-insensitively, like the microsample checklists)
+ALIAS = 'alias'
+CRYOSECTION = 'sample_attribute[cryosection]'
+XCOORD = 'sample_attribute[xcoord]'
+YCOORD = 'sample_attribute[ycoord]'
+XPIXEL = 'sample_attribute[xpixel]'
+YPIXEL = 'sample_attribute[ypixel]'
+SIZE = 'sample_attribute[size]'
+SPATIAL_COLUMNS = [ALIAS, CRYOSECTION, XCOORD, YCOORD, XPIXEL, YPIXEL, SIZE]
+NUMERIC_COLUMNS = [XCOORD, YCOORD, XPIXEL, YPIXEL, SIZE]
+
+OVERLAP_TOLERANCE = 1e-6  # Spots that only touch do not overlap
+CELL_FACTOR = 2           # Grid cells are this many median spot diameters wide
+MAX_CANDIDATES = 4000000  # Candidate pairs compared at once
+SIZE_FACTOR = 100         # Sizes this many times the median of their cryosection are taken for typos
+PIXEL_TOLERANCE = 2       # Pixels a coordinate may deviate from the cryosection's pixel-to-coordinate fit
+RESIDUAL_FACTOR = 5       # ... or this many robust standard deviations, whichever is larger
+MIN_FIT_SAMPLES = 3       # Cryosections with fewer microsamples are not fitted
+MAX_REPORTED = 100        # Problems printed by report_spatial
+
+def read_spatial_columns(metadata: str, chunksize: int = None):
+    """Read the alias, cryosection, coordinate, pixel and size columns of a metadata table."""
+    wanted = set(SPATIAL_COLUMNS)
+    chunks = read_metadata(metadata, chunksize, usecols=lambda column: column.lower() in wanted)
+    df = pd.concat(chunks, ignore_index=True)
+    df.columns = [column.lower() for column in df.columns]
+    missing = [column for column in SPATIAL_COLUMNS if column not in df.columns]
+    if missing:
+        raise KeyError(f"Missing expected columns in metadata: {missing}")
+    return df
+
+def grid_pairs(group, x, y, radius, width, queries=None):
+    """Return the index pairs of overlapping spots found in a uniform grid, `width` wide per group.
+
+    Without queries, every spot is paired with the spots after it in its own cell and
+    with those of half of its neighbouring cells, so each pair of spots in the same or
+    adjacent cells is compared once. With queries (spot indices), each of them is
+    compared with every spot of its 3x3 neighbourhood. Candidates are compared in
+    chunks, so memory stays bounded however crowded the cells are.
+    """
+    n = len(x)
+    ix = np.floor(x / width).astype(np.int64)
+    iy = np.floor(y / width).astype(np.int64)
+
+    # One integer key per (group, cell), with a margin so neighbours never wrap into another group
+    ix -= ix.min() - 1
+    iy -= iy.min() - 1
+    nx, ny = ix.max() + 2, iy.max() + 2
+    keys = (group.astype(np.int64) * nx + ix) * ny + iy
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    if queries is None:
+        sources = np.arange(n)  # Positions in sorted order
+        offsets = [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]
+    else:
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n)
+        sources = rank[queries]
+        offsets = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+    left, right = [], []
+    for dx, dy in offsets:
+        target = sorted_keys[sources] + dx * ny + dy
+        starts = np.searchsorted(sorted_keys, target, side="left")
+        ends = np.searchsorted(sorted_keys, target, side="right")
+        if queries is None and dx == 0 and dy == 0:
+            # Within a cell, pair each spot with the spots after it only
+            starts = sources + 1
+        counts = np.maximum(ends - starts, 0)
+        # Split the sources so that each chunk yields at most MAX_CANDIDATES pairs
+        bounds = np.searchsorted(np.cumsum(counts), np.arange(0, counts.sum(), MAX_CANDIDATES), side="right")
+        for first, last in zip(bounds, np.append(bounds[1:], len(sources))):
+            chunk = counts[first:last]
+            total = chunk.sum()
+            if total == 0:
+                continue
+            k = np.repeat(np.arange(first, last), chunk)
+            # Position of every candidate within its source's run, added to the run start
+            positions = starts[k] + np.arange(total) - np.repeat(np.cumsum(chunk) - chunk, chunk)
+            i, j = order[sources[k]], order[positions]
+            overlap = (np.hypot(x[i] - x[j], y[i] - y[j]) < radius[i] + radius[j] - OVERLAP_TOLERANCE) & (i != j)
+            left.append(i[overlap])
+            right.append(j[overlap])
+    return left, right
+
+def overlapping_pairs(group, x, y, radius):
+    """Return the index pairs (i, j), i < j, of spots of the same group whose circles overlap.
+
+    Spots are hashed into a uniform grid per group, with cells CELL_FACTOR times as
+    wide as the median spot of the group, so overlapping spots of up to that size
+    always share a cell or are in adjacent cells. Larger spots are compared with
+    their neighbours in coarser grids, one per doubling of the spot size, so a few
+    large spots cannot put a whole group into a single cell. Time and memory grow
+    linearly with the number of spots for spots of similar size.
+    """
+    n = len(x)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    groups = group.max() + 1
+    cell = CELL_FACTOR * 2 * pd.Series(radius).groupby(group).median().reindex(range(groups)).to_numpy()
+    cell[~(cell > 0)] = 1.0
+    width = cell[group]
+    left, right = grid_pairs(group, x, y, radius, width)
+
+    # A spot at level l is at most 2^l cells wide: it meets every spot of its own
+    # or a lower level in a grid of cells 2^l times as wide
+    level = np.ceil(np.log2(np.maximum(2 * radius / width, 1))).astype(np.int64)
+    for l in np.unique(level[level > 0]):
+        more_left, more_right = grid_pairs(group, x, y, radius, width * 2.0 ** l, np.flatnonzero(level == l))
+        left += more_left
+        right += more_right
+
+    if not left:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    i, j = np.concatenate(left), np.concatenate(right)
+    # Pairs found from both of their spots are kept once
+    pairs = np.unique(np.minimum(i, j) * n + np.maximum(i, j))
+    return pairs // n, pairs % n
+
+def pixel_outliers(group, pixel, coord):
+    """Return a mask of spots whose coordinate does not follow the pixel-to-coordinate line of their group.
+
+    The line is fitted per group by least squares, twice: the second fit leaves out
+    the spots that were far off the first one.
+    """
+    groups = group.max() + 1
+    keep = np.ones(len(group), dtype=bool)
+    for _ in range(2):
+        w = keep.astype(float)
+        n = np.bincount(group, weights=w, minlength=groups)
+        sx = np.bincount(group, weights=w * pixel, minlength=groups)
+        sy = np.bincount(group, weights=w * coord, minlength=groups)
+        sxx = np.bincount(group, weights=w * pixel * pixel, minlength=groups)
+        sxy = np.bincount(group, weights=w * pixel * coord, minlength=groups)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = sxx - sx * sx / n
+            slope = np.where(variance > 0, (sxy - sx * sy / n) / variance, np.nan)
+            intercept = (sy - slope * sx) / n
+        residual = np.abs(coord - (intercept[group] + slope[group] * pixel))
+
+        # Robust spread of the residuals of every group (median absolute deviation)
+        sigma = 1.4826 * pd.Series(residual[keep]).groupby(group[keep]).median().reindex(range(groups)).to_numpy()
+        tolerance = np.fmax(PIXEL_TOLERANCE * np.abs(slope), RESIDUAL_FACTOR * sigma)
+        fitted = (n >= MIN_FIT_SAMPLES) & np.isfinite(slope)
+        outlier = fitted[group] & (residual > tolerance[group])
+        keep = ~outlier
+    return outlier
+
+def spatial_check(df: pd.DataFrame):
+    """Validate the microsample coordinates of a metadata table, cryosection by cryosection.
+
+    Flags missing and non-numeric values, negative pixels, sizes that are not
+    positive or far above the median of their cryosection, duplicated coordinates, capture spots that overlap (spots are circles
+    with `size` as their area, in coordinate units) and coordinates that do not
+    match their pixel position. Returns a list of problems, empty if all is well.
+    """
+    problems = []
+    df = df.reset_index(drop=True)
+    aliases = df[ALIAS].astype(str).to_numpy()
+    values = {column: pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=float) for column in NUMERIC_COLUMNS}
+
+    # Missing and invalid values
+    missing_cryosection = df[CRYOSECTION].isna().to_numpy()
+    problems += [f"{aliases[i]}: {CRYOSECTION} is missing" for i in np.flatnonzero(missing_cryosection)]
+    invalid = missing_cryosection.copy()
+    for column in NUMERIC_COLUMNS:
+        bad = ~np.isfinite(values[column])
+        problems += [f"{aliases[i]}: {column} is missing or not a number" for i in np.flatnonzero(bad)]
+        invalid |= bad
+    for column in [XPIXEL, YPIXEL]:
+        problems += [f"{aliases[i]}: {column} is negative ({values[column][i]:g})" for i in np.flatnonzero(values[column] < 0)]
+    problems += [f"{aliases[i]}: {SIZE} is not positive ({values[SIZE][i]:g})" for i in np.flatnonzero(values[SIZE] <= 0)]
+    invalid |= values[SIZE] <= 0
+
+    # Sizes far above the rest of their cryosection are most likely typos
+    valid = np.flatnonzero(~invalid)
+    cryosection = df[CRYOSECTION].to_numpy()[valid].astype(str)
+    median = pd.Series(values[SIZE][valid]).groupby(cryosection).transform("median").to_numpy()
+    oversized = values[SIZE][valid] > SIZE_FACTOR * median
+    problems += [
+        f"{aliases[k]}: {SIZE} ({values[SIZE][k]:g}) is more than {SIZE_FACTOR} times the median of cryosection {c} ({m:g})"
+        for k, c, m in zip(valid[oversized], cryosection[oversized], median[oversized])
+    ]
+    valid = valid[~oversized]
+    if len(valid) == 0:
+        return problems
+    cryosections, group = np.unique(df[CRYOSECTION].to_numpy()[valid].astype(str), return_inverse=True)
+    x, y = values[XCOORD][valid], values[YCOORD][valid]
+    aliases = aliases[valid]
+
+    # Duplicated coordinates within a cryosection
+    duplicated = pd.DataFrame({"group": group, "x": x, "y": y}).duplicated(keep=False).to_numpy()
+    for (cryosection, xcoord, ycoord), members in pd.Series(aliases[duplicated]).groupby(
+            [cryosections[group[duplicated]], x[duplicated], y[duplicated]], sort=True):
+        problems.append(f"{', '.join(members)}: same coordinates ({xcoord:g}, {ycoord:g}) in cryosection {cryosection}")
+
+    # Overlapping capture spots (duplicates are reported once, above)
+    radius = np.sqrt(values[SIZE][valid] / np.pi)
+    i, j = overlapping_pairs(group, x, y, radius)
+    distinct = (x[i] != x[j]) | (y[i] != y[j])
+    for a, b in zip(i[distinct], j[distinct]):
+        problems.append(f"{aliases[a]}, {aliases[b]}: capture spots overlap in cryosection {cryosections[group[a]]} "
+                        f"({np.hypot(x[a] - x[b], y[a] - y[b]):g} apart, radii {radius[a]:g} and {radius[b]:g})")
+
+    # Coordinates that do not match their pixel position
+    for pixel, coord in [(XPIXEL, XCOORD), (YPIXEL, YCOORD)]:
+        outlier = pixel_outliers(group, values[pixel][valid], values[coord][valid])
+        problems += [
+            f"{aliases[k]}: {coord} ({values[coord][valid][k]:g}) does not match {pixel} ({values[pixel][valid][k]:g}) "
+            f"in cryosection {cryosections[group[k]]}"
+            for k in np.flatnonzero(outlier)
+        ]
+    return problems
+
+def report_spatial(problems: list):
+    """Print the spatial validation report and exit if any problem was found."""
+    if not problems:
+        print("Spatial check passed.")
+        return
+    print(f"Spatial check failed with {len(problems)} problems:")
+    for problem in problems[:MAX_REPORTED]:
+        print(f"    {problem}")
+    if len(problems) > MAX_REPORTED:
+        print(f"    ... and {len(problems) - MAX_REPORTED} more")
+    print("Fix the metadata table, or use --no-spatial-check to skip this check.")
+    sys.exit(1)
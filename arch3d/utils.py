@@ -5,11 +5,24 @@ import subprocess
 import yaml
 import re
 import json
+import time
+import fcntl
+import base64
+import gzip
+import zlib
+import hashlib
+import threading
 import requests
 import pandas as pd
 from pathlib import Path
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
+from arch3d.metrics import METRICS
+from arch3d.responses import save_json, JsonResponseStore, ResponseArchive, open_response_store, lookup_responses
+from arch3d.registry import SampleRegistry, DEFAULT_ENDPOINT
+from arch3d.ratecontrol import RateController, THROTTLE_STATUSES, RETRY_STATUSES, retry_after
 
 ######
 # nucleotide
@@ -21,89 +34,353 @@ def create_secret(username: str, password: str, output_file: str):
         'username': username,
         'password': password
     }
-    with open(output_file, 'w') as file:
-        yaml.dump(data, file, default_flow_style=False)
+    write_text_files([(output_file, yaml.dump(data, default_flow_style=False))])
+
+# Checklist columns
+EXPERIMENT_COLUMNS = ['alias','title','study_alias','sample_alias','design_description','library_name','library_strategy','library_source','library_selection','library_layout','insert_size','library_construction_protocol','platform','instrument_model']
+SAMPLE_COLUMNS = ['alias','sample_alias','taxon_id','sample_description','sample collection method','project name','collection date','geographic location (latitude)','geographic location (longitude)','geographic location (region and locality)','broad-scale environmental context','local environmental context','environmental medium','geographic location (country and/or sea)','host common name','host subject id','host taxid','host body site','host life stage','host sex']
+MICROSAMPLE_COLUMNS = SAMPLE_COLUMNS + ['sample_attribute[cryosection]','sample_attribute[xcoord]','sample_attribute[ycoord]','sample_attribute[xpixel]','sample_attribute[ypixel]','sample_attribute[size]','sample_attribute[buffer]','sample_attribute[sampletype]']
+
+def format_tsv_field(value):
+    """Render a value as DataFrame.to_csv(sep='\\t') would: NaN as empty, minimal quoting."""
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    text = str(value)
+    if any(char in text for char in '\t"\r\n'):
+        text = '"' + text.replace('"', '""') + '"'
+    return text
+
+def format_tsv_lines(df):
+    """Render every row of a DataFrame as one TSV line, in a single vectorized pass."""
+    text = df.astype(object).where(df.notna(), "").astype(str)
+    for col in text.columns:
+        needs_quotes = text[col].str.contains('[\t"\r\n]', regex=True)
+        if needs_quotes.any():
+            text.loc[needs_quotes, col] = '"' + text.loc[needs_quotes, col].str.replace('"', '""') + '"'
+    columns = list(text.columns)
+    return text[columns[0]].str.cat([text[col] for col in columns[1:]], sep="\t").tolist()
+
+def format_tsv_header(columns):
+    return "\t".join(format_tsv_field(col) for col in columns) + os.linesep
+
+def unchanged(path, content: str):
+    """Return True if the file at path already holds exactly this content."""
+    try:
+        with open(path, 'r', newline='') as f:
+            return f.read() == content
+    except (FileNotFoundError, UnicodeDecodeError):
+        return False
+
+def write_text_files(files):
+    """Write (path, content) pairs with plain buffered writes, leaving files with the same content untouched.
+
+    Unchanged files keep their modification time, so Snakemake does not upload
+    their samples again. Returns the number of files written.
+    """
+    written = 0
+    for path, content in files:
+        if unchanged(path, content):
+            continue
+        with open(path, 'w', newline='') as f:
+            f.write(content)
+        written += 1
+    return written
+
+def write_checklist_files(files, workers=1):
+    """Write (path, content) pairs, optionally spread over a pool of processes. Returns the number of files written."""
+    if workers <= 1 or len(files) < 2 * workers:
+        return write_text_files(files)
+    chunksize = -(-len(files) // workers)
+    chunks = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(write_text_files, chunks))
+
+# Create separate run checklist contents for each sample
+def run_checklist_files(df: pd.DataFrame, output_dir: str, checksums: dict = None):
+    aliases = df['alias'].tolist()
+    forward = pd.DataFrame({'alias': df['alias'], 'experiment_alias': df['alias'], 'file_name': df['forward_filename'], 'file_type': 'fastq'})
+    reverse = pd.DataFrame({'alias': df['alias'], 'experiment_alias': df['alias'], 'file_name': df['reverse_filename'], 'file_type': 'fastq'})
+    if checksums is not None:
+        # Precomputed MD5s spare ena-upload-cli from hashing the files again
+        forward['file_checksum'] = [checksums[alias][0] for alias in aliases]
+        reverse['file_checksum'] = [checksums[alias][1] for alias in aliases]
+    header = format_tsv_header(forward.columns)
+    forward = format_tsv_lines(forward)
+    reverse = format_tsv_lines(reverse)
+    return [
+        (os.path.join(output_dir, f"{alias}.tsv"), header + forward_line + os.linesep + reverse_line + os.linesep)
+        for alias, forward_line, reverse_line in zip(aliases, forward, reverse)
+    ]
+
+# Create separate experiment checklist contents for each sample
+def experiment_checklist_files(df: pd.DataFrame, output_dir: str):
+    df = df[EXPERIMENT_COLUMNS]
+    header = format_tsv_header(EXPERIMENT_COLUMNS)
+    return [
+        (os.path.join(output_dir, f"{alias}.tsv"), header + line + os.linesep)
+        for alias, line in zip(df['alias'].tolist(), format_tsv_lines(df))
+    ]
+
+# Create separate sample checklist contents for each sample
+def sample_checklist_files(df: pd.DataFrame, output_dir: str, microsample: bool = False):
+    if microsample:
+        # Match columns case-insensitively so CSV headers like Xcoord/xcoord both work
+        lower_lookup = {col.lower(): col for col in df.columns}
+        missing = [col for col in MICROSAMPLE_COLUMNS if col not in lower_lookup]
+        if missing:
+            raise KeyError(f"Missing expected columns in metadata: {missing}")
+        df = df[[lower_lookup[col] for col in MICROSAMPLE_COLUMNS]]
+    else:
+        df = df[SAMPLE_COLUMNS]
+    filenames = df[df.columns[0]].tolist()
+    df = df.drop(columns=df.columns[0]).rename(columns={'sample_alias': 'alias'})
+    df = df.assign(title=df['alias'])
+    header = format_tsv_header(df.columns)
+    return [
+        (os.path.join(output_dir, f"{filename}.tsv"), header + line + os.linesep)
+        for filename, line in zip(filenames, format_tsv_lines(df))
+    ]
+
+def data_dict(df: pd.DataFrame, directory: str):
+    return {
+        alias: [
+            os.path.abspath(os.path.join(directory, forward)),
+            os.path.abspath(os.path.join(directory, reverse))
+        ]
+        for alias, forward, reverse in zip(df['alias'], df['forward_filename'], df['reverse_filename'])
+    }
+
+def read_metadata(metadata: str, chunksize: int = None, **kwargs):
+    """Yield the metadata table as a single DataFrame, or in DataFrames of at most chunksize rows.
+
+    Values are read as text, as typed in the table: types inferred by pandas would
+    depend on the rows of each chunk (e.g. 300 or 300.0 next to an empty cell).
+    """
+    kwargs.setdefault("dtype", str)
+    if chunksize:
+        yield from pd.read_csv(metadata, sep=',', chunksize=chunksize, **kwargs)
+    else:
+        yield pd.read_csv(metadata, sep=',', **kwargs)
 
 # Create separate run checklist files for each sample
-def create_run_checklists(metadata: str, output_dir: str):
-    df = pd.read_csv(metadata, sep=',')
+def create_run_checklists(metadata: str, output_dir: str, chunksize: int = None):
     os.makedirs(output_dir, exist_ok=True)
-    for _, row in df.iterrows():
-        alias = row['alias']
-        output_file = os.path.join(output_dir, f"{alias}.tsv")
-        transformed_data = [
-            [alias, alias, row['forward_filename'], 'fastq'],
-            [alias, alias, row['reverse_filename'], 'fastq']
-        ]
-        output_df = pd.DataFrame(transformed_data, columns=['alias', 'experiment_alias', 'file_name', 'file_type'])
-        output_df.to_csv(output_file, sep='\t', index=False)
+    for df in read_metadata(metadata, chunksize):
+        write_text_files(run_checklist_files(df, output_dir))
 
 # Create separate experiment checklist files for each sample
-def create_experiment_checklists(metadata: str, output_dir: str):
-    df = pd.read_csv(metadata, sep=',')
-    df = df[['alias','title','study_alias','sample_alias','design_description','library_name','library_strategy','library_source','library_selection','library_layout','insert_size','library_construction_protocol','platform','instrument_model']]
+def create_experiment_checklists(metadata: str, output_dir: str, chunksize: int = None):
     os.makedirs(output_dir, exist_ok=True)
-    for _, row in df.iterrows():
-        alias = row['alias']
-        output_file = os.path.join(output_dir, f"{alias}.tsv")
-        output_df = pd.DataFrame([row])
-        output_df.to_csv(output_file, sep='\t', index=False)
+    for df in read_metadata(metadata, chunksize):
+        write_text_files(experiment_checklist_files(df, output_dir))
 
 # Create separate sample checklist files for each sample
-def create_sample_checklists(metadata: str, output_dir: str):
-    df = pd.read_csv(metadata, sep=',')
-    df = df[['alias','sample_alias','taxon_id','sample_description','sample collection method','project name','collection date','geographic location (latitude)','geographic location (longitude)','geographic location (region and locality)','broad-scale environmental context','local environmental context','environmental medium','geographic location (country and/or sea)','host common name','host subject id','host taxid','host body site','host life stage','host sex']]
-    df = df.rename(columns={'alias': 'filename'})
-    df = df.rename(columns={'sample_alias': 'alias'})
-    df['title'] = df['alias']
+def create_sample_checklists(metadata: str, output_dir: str, chunksize: int = None):
     os.makedirs(output_dir, exist_ok=True)
-    for _, row in df.iterrows():
-        filename = row['filename']
-        output_file = os.path.join(output_dir, f"{filename}.tsv")
-        output_df = pd.DataFrame([row.drop('filename')])
-        output_df.to_csv(output_file, sep='\t', index=False)
-
-def create_microsample_checklists(metadata: str, output_dir: str):
-    df = pd.read_csv(metadata, sep=',')
-    # Match columns case-insensitively so CSV headers like Xcoord/xcoord both work
-    expected_cols = ['alias','sample_alias','taxon_id','sample_description','sample collection method','project name','collection date','geographic location (latitude)','geographic location (longitude)','geographic location (region and locality)','broad-scale environmental context','local environmental context','environmental medium','geographic location (country and/or sea)','host common name','host subject id','host taxid','host body site','host life stage','host sex','sample_attribute[cryosection]','sample_attribute[xcoord]','sample_attribute[ycoord]','sample_attribute[xpixel]','sample_attribute[ypixel]','sample_attribute[size]','sample_attribute[buffer]','sample_attribute[sampletype]']
-    lower_lookup = {col.lower(): col for col in df.columns}
-    missing = [col for col in expected_cols if col not in lower_lookup]
-    if missing:
-        raise KeyError(f"Missing expected columns in metadata: {missing}")
-    selected_cols = [lower_lookup[col] for col in expected_cols]
-    df = df[selected_cols]
-    df = df.rename(columns={'alias': 'filename'})
-    df = df.rename(columns={'sample_alias': 'alias'})
-    df['title'] = df['alias']
+    for df in read_metadata(metadata, chunksize):
+        write_text_files(sample_checklist_files(df, output_dir))
+
+def create_microsample_checklists(metadata: str, output_dir: str, chunksize: int = None):
     os.makedirs(output_dir, exist_ok=True)
-    for _, row in df.iterrows():
-        filename = row['filename']
-        output_file = os.path.join(output_dir, f"{filename}.tsv")
-        output_df = pd.DataFrame([row.drop('filename')])
-        output_df.to_csv(output_file, sep='\t', index=False)
-
-def create_data_dict(metadata: str, directory: str, output_json: str):
-    df = pd.read_csv(metadata, sep=',')
-    sample_dict = {
-        row['alias']: [
-            os.path.abspath(os.path.join(directory, row['forward_filename'])),
-            os.path.abspath(os.path.join(directory, row['reverse_filename']))
-        ]
-        for _, row in df.iterrows()
-    }
-    with open(output_json, 'w') as json_file:
-        json.dump(sample_dict, json_file, indent=4)
+    for df in read_metadata(metadata, chunksize):
+        write_text_files(sample_checklist_files(df, output_dir, microsample=True))
+
+def create_data_dict(metadata: str, directory: str, output_json: str, chunksize: int = None):
+    sample_dict = {}
+    for df in read_metadata(metadata, chunksize, usecols=['alias', 'forward_filename', 'reverse_filename']):
+        sample_dict.update(data_dict(df, directory))
+    write_text_files([(output_json, json.dumps(sample_dict, indent=4))])
+
+def md5_file(path: str, chunk_size: int = 8 * 1024 * 1024):
+    """Compute the MD5 checksum of a file with streaming reads."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# Compute MD5 checksums of all data files, reusing those cached for unchanged files
+def create_checksums(sample_dict: dict, cache_json: str, workers: int = 1):
+    cache = {}
+    if os.path.exists(cache_json):
+        with open(cache_json, 'r') as f:
+            cache = json.load(f)
+
+    paths = sorted({path for files in sample_dict.values() for path in files})
+    stats = {}
+    for path in paths:
+        try:
+            stats[path] = os.stat(path)
+        except FileNotFoundError:
+            print(f"Error: The data file '{path}' does not exist.")
+            sys.exit(1)
+
+    # Files are identified by path, size and modification time
+    pending = [
+        path for path in paths
+        if path not in cache
+        or cache[path]['size'] != stats[path].st_size
+        or cache[path]['mtime_ns'] != stats[path].st_mtime_ns
+    ]
+    if pending:
+        print(f"Computing checksums of {len(pending)} files ({len(paths) - len(pending)} cached)")
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for path, md5 in zip(pending, executor.map(md5_file, pending)):
+                cache[path] = {'size': stats[path].st_size, 'mtime_ns': stats[path].st_mtime_ns, 'md5': md5}
+
+        tmp_json = f"{cache_json}.tmp"
+        with open(tmp_json, 'w') as f:
+            json.dump(cache, f, indent=4)
+        os.replace(tmp_json, cache_json)
+
+    return {alias: [cache[path]['md5'] for path in files] for alias, files in sample_dict.items()}
+
+# Create the data dictionary and all checklists from a single read of the metadata table
+# (or, with chunksize, from chunks of rows so memory use does not grow with the table)
+def create_checklists(metadata: str, directory: str, output_dir: str, microsample: bool = False, workers: int = 1, checksums: bool = True, chunksize: int = None):
+    METRICS.reset()
+    output_dir = Path(output_dir)
+    with METRICS.span("read_metadata"):
+        if chunksize:
+            # Only the file columns are needed up front, for input.json and the checksums
+            df = pd.concat(read_metadata(metadata, chunksize, usecols=['alias', 'forward_filename', 'reverse_filename']), ignore_index=True)
+        else:
+            df = next(read_metadata(metadata))
+    sample_dict = data_dict(df, directory)
+    write_text_files([(output_dir / 'input' / 'input.json', json.dumps(sample_dict, indent=4))])
+    file_checksums = None
+    if checksums:
+        with METRICS.span("checksums"):
+            file_checksums = create_checksums(sample_dict, str(output_dir / 'input' / 'checksums.json'), workers)
+    for checklist in ['run', 'experiment', 'sample']:
+        os.makedirs(output_dir / 'checklists' / checklist, exist_ok=True)
+    samples = len(df)
+    chunks = read_metadata(metadata, chunksize) if chunksize else [df]
+    del df
+    total = written = 0
+    for chunk in chunks:
+        files = []
+        with METRICS.span("build_checklists"):
+            files += run_checklist_files(chunk, str(output_dir / 'checklists' / 'run'), file_checksums)
+            files += experiment_checklist_files(chunk, str(output_dir / 'checklists' / 'experiment'))
+            files += sample_checklist_files(chunk, str(output_dir / 'checklists' / 'sample'), microsample)
+        with METRICS.span("write_checklists"):
+            chunk_written = write_checklist_files(files, workers)
+        total += len(files)
+        written += chunk_written
+        METRICS.increment("checklist_files", len(files))
+        METRICS.increment("checklist_files_written", chunk_written)
+    print(f"Checklists written: {written} of {total} files changed")
+    METRICS.write(output_dir / 'metrics', 'prepare', throughput={"samples": samples})
+
+######
+# preflight
+######
+
+def check_fastq_file(path: str):
+    """Stream a (gzipped) FASTQ file checking compression integrity and record structure.
+
+    Returns the number of records and an error message (None if the file is valid).
+    """
+    records = 0
+    opener = gzip.open if path.endswith('.gz') else open
+    try:
+        with opener(path, 'rb') as f:
+            while True:
+                header = f.readline()
+                if not header:
+                    break
+                sequence = f.readline()
+                separator = f.readline()
+                quality = f.readline()
+                if not header.startswith(b'@'):
+                    return records, f"record {records + 1} does not start with '@'"
+                if not separator.startswith(b'+'):
+                    return records, f"record {records + 1} has no '+' separator line"
+                if not quality or len(sequence.rstrip(b'\r\n')) != len(quality.rstrip(b'\r\n')):
+                    return records, f"record {records + 1} is truncated or its sequence and quality lengths differ"
+                records += 1
+    except (OSError, EOFError, zlib.error) as e:
+        return records, f"corrupt or truncated file ({e})"
+    if records == 0:
+        return records, "file contains no FASTQ records"
+    return records, None
+
+def preflight_check(metadata: str, directory: str, workers: int = 1):
+    """Validate the metadata and data files before launching the workflow.
+
+    Returns a list of problems, which is empty if everything is ready for upload.
+    """
+    df = next(read_metadata(metadata))
+    problems = []
+
+    # Duplicated aliases and files
+    duplicated = df['alias'][df['alias'].duplicated()].unique()
+    problems += [f"{alias}: alias is used by more than one row" for alias in duplicated]
+
+    sample_dict = data_dict(df, directory)
+    owners = defaultdict(list)
+    for alias, forward, reverse in zip(df['alias'], df['forward_filename'], df['reverse_filename']):
+        for filename in [forward, reverse]:
+            owners[os.path.abspath(os.path.join(directory, filename))].append(alias)
+    problems += [f"{path}: file is referenced {len(aliases)} times ({', '.join(map(str, aliases))})" for path, aliases in owners.items() if len(aliases) > 1]
+
+    # Missing and empty files
+    for path in owners:
+        try:
+            if os.stat(path).st_size == 0:
+                problems.append(f"{path}: file is empty")
+        except FileNotFoundError:
+            problems.append(f"{path}: file does not exist")
+
+    # Fail fast before reading any file contents
+    if problems:
+        return problems
+
+    # Stream-check file contents in parallel
+    paths = list(owners)
+    print(f"Checking {len(paths)} data files with {workers} workers")
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = dict(zip(paths, executor.map(check_fastq_file, paths)))
+
+    for path, (records, error) in results.items():
+        if error:
+            problems.append(f"{path}: {error}")
+
+    # Paired files must contain the same number of reads
+    for alias, (forward, reverse) in sample_dict.items():
+        if not results[forward][1] and not results[reverse][1] and results[forward][0] != results[reverse][0]:
+            problems.append(f"{alias}: forward and reverse files contain {results[forward][0]} and {results[reverse][0]} reads")
+
+    return problems
+
+def report_preflight(problems: list):
+    """Print the preflight report and exit if any problem was found."""
+    if not problems:
+        print("Preflight check passed.")
+        return
+    print(f"Preflight check failed with {len(problems)} problems:")
+    for problem in problems:
+        print(f"    {problem}")
+    sys.exit(1)
 
 ######
 # sample
 ######
 
 # API Endpoints
-AUTH_URL = "https://www.ebi.ac.uk/ena/submit/webin/auth/token"
-BIOSAMPLE_URL = "https://www.ebi.ac.uk/biosamples/samples"
-STRUCTUREDDATA_URL = "https://www.ebi.ac.uk/biosamples/structureddata"
+EBI_URL = os.environ.get("ARCH3D_EBI_URL", DEFAULT_ENDPOINT)
+AUTH_URL = f"{EBI_URL}/ena/submit/webin/auth/token"
+BIOSAMPLE_URL = f"{EBI_URL}/biosamples/samples"
+STRUCTUREDDATA_URL = f"{EBI_URL}/biosamples/structureddata"
 
+def set_ebi_url(base_url):
+    """Point all API endpoints to another base URL, e.g. a local mock service."""
+    global EBI_URL, AUTH_URL, BIOSAMPLE_URL, STRUCTUREDDATA_URL
+    EBI_URL = base_url.rstrip("/")
+    AUTH_URL = f"{EBI_URL}/ena/submit/webin/auth/token"
+    BIOSAMPLE_URL = f"{EBI_URL}/biosamples/samples"
+    STRUCTUREDDATA_URL = f"{EBI_URL}/biosamples/structureddata"
 
 def normalize_taxid(value):
     """Return taxId as an int (API expects a long), stripping trailing decimals."""
@@ -130,7 +407,7 @@ def get_token(username, password):
         "Accept": "*/*",
         "Content-Type": "application/json"
     }
-    response = requests.post(AUTH_URL, headers=headers, json=payload)
+    response = timed_request(requests, "POST", AUTH_URL, "get_token", headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
     if response.status_code == 200:
         return response.text.strip()  # Extract token as a string
     else:
@@ -138,124 +415,393 @@ def get_token(username, password):
         print(f"Response content: {response.text}")
         sys.exit(1)
 
-def post_sample(sample_json, token):
+# Webin tokens
+
+TOKEN_CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "arch3d"
+TOKEN_LIFETIME = 3600  # Assumed lifetime (s) of tokens without a readable expiry
+TOKEN_MARGIN = 300     # Tokens are refreshed this many seconds before they expire
+
+def token_expiry(token):
+    """Return the expiry time (epoch seconds) of a Webin JWT token."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, ValueError, TypeError):
+        return time.time() + TOKEN_LIFETIME
+
+class TokenManager:
+    """Webin token shared by all workers of a run and cached on disk between runs.
+
+    The token is refreshed shortly before it expires, or when a request is rejected
+    with 401. The cache file is locked while it is read or refreshed, so concurrent
+    workers and parallel invocations authenticate only once.
+    """
+
+    def __init__(self, username, password, cache_dir=None):
+        self.username = username
+        self.password = password
+        user_hash = hashlib.sha256(f"{AUTH_URL} {username}".encode()).hexdigest()[:16]
+        self.cache_path = Path(cache_dir or TOKEN_CACHE_DIR) / f"token_{user_hash}.json"
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires = 0
+
+    def get(self):
+        """Return a valid token, refreshing it if it is about to expire."""
+        with self.lock:
+            if self.token is None or time.time() > self.expires - TOKEN_MARGIN:
+                self._obtain(stale=self.token)
+            return self.token
+
+    def refresh(self, stale):
+        """Replace a token rejected by the API, unless another worker already did."""
+        with self.lock:
+            if self.token == stale:
+                self._obtain(stale=stale)
+            return self.token
+
+    def _obtain(self, stale=None):
+        os.makedirs(self.cache_path.parent, mode=0o700, exist_ok=True)
+        with open(f"{self.cache_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.cache_path, "r") as f:
+                    cached = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                cached = {}
+            if cached.get("token") and cached["token"] != stale and time.time() < cached["expires"] - TOKEN_MARGIN:
+                self.token, self.expires = cached["token"], cached["expires"]
+                return
+            self.token = get_token(self.username, self.password)
+            self.expires = token_expiry(self.token)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                json.dump({"token": self.token, "expires": self.expires}, f)
+            os.replace(tmp_path, self.cache_path)
+
+REQUEST_TIMEOUT = (10, 120)  # Seconds to connect, and to wait for the response
+
+# Concurrency and rate of BioSample requests, shared by all workers of a run
+RATE_CONTROLLER = RateController()
+
+def create_session(pool_size=1):
+    """Create an HTTP session that keeps connections to EBI alive across requests."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def timed_request(http, method, url, operation, **kwargs):
+    """Send a request, recording its latency, status and size in the run metrics."""
+    with METRICS.span(f"http_{operation}"):
+        response = http.request(method, url, **kwargs)
+    METRICS.increment("http_requests", operation=operation, status=str(response.status_code))
+    data = kwargs.get("data") or b""
+    METRICS.increment("bytes_sent", len(data.encode() if isinstance(data, str) else data))
+    METRICS.increment("bytes_received", len(response.content))
+    return response
+
+def retryable(method, status=None, error=None):
+    """Whether a failed request can be sent again without side effects.
+
+    A POST that reached the service may have created the sample, so it is only
+    retried when the service refused it (429/503) or the connection never opened.
+    """
+    if error is not None:
+        return isinstance(error, requests.ConnectTimeout) if method == "POST" else isinstance(error, (requests.ConnectionError, requests.Timeout))
+    return status in (THROTTLE_STATUSES if method == "POST" else RETRY_STATUSES)
+
+def send_request(method, url, token, session=None, headers=None, operation=None, **kwargs):
+    """Send an authenticated request through the shared rate controller.
+
+    Throttled, failed and timed out requests are retried with jittered backoff
+    (honouring Retry-After) while the retry budget of the run lasts. The token is
+    renewed once if it is rejected.
+    """
+    http = session or requests
+    operation = operation or method.lower()
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    bearer = token.get() if isinstance(token, TokenManager) else token
+    headers = dict(headers or {}, Authorization=f"Bearer {bearer}")
+    attempt = 0
+    refreshed = False
+    while True:
+        attempt += 1
+        RATE_CONTROLLER.acquire()
+        start = time.perf_counter()
+        status = None
+        failure = None
+        try:
+            response = timed_request(http, method, url, operation, headers=headers, **kwargs)
+            status = response.status_code
+        except (requests.ConnectionError, requests.Timeout) as error:
+            failure = error
+        finally:
+            # The slot is given back whatever was raised, before any backoff
+            RATE_CONTROLLER.release(time.perf_counter() - start, status)
+        if failure is not None:
+            reason = "timeout" if isinstance(failure, requests.Timeout) else "connection"
+            METRICS.increment("http_errors", operation=operation, reason=reason)
+            if retryable(method, error=failure) and RATE_CONTROLLER.retry(attempt):
+                METRICS.increment("http_retries", operation=operation, reason=reason)
+                continue
+            raise failure
+
+        if status == 401 and isinstance(token, TokenManager) and not refreshed:
+            METRICS.increment("http_retries", operation=operation, reason="401")
+            bearer = token.refresh(bearer)
+            headers["Authorization"] = f"Bearer {bearer}"
+            refreshed = True
+            attempt -= 1
+            continue
+        if retryable(method, status=status):
+            if RATE_CONTROLLER.retry(attempt, retry_after(response)):
+                METRICS.increment("http_retries", operation=operation, reason=str(status))
+                continue
+            METRICS.increment("http_retries_exhausted", operation=operation, reason=str(status))
+        return response
+
+def post_sample(sample_json, token, session=None):
     """Send POST request to create a sample."""
     headers = {
         "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}"
+        "Content-Type": "application/json"
     }
-    response = requests.post(BIOSAMPLE_URL, headers=headers, data=json.dumps(sample_json))
+    response = send_request("POST", BIOSAMPLE_URL, token, session, headers, "post_sample", data=json.dumps(sample_json))
     return response
 
-def update_sample(updated_json, accession, token):
+def update_sample(updated_json, accession, token, session=None):
     """Send PUT request to update a sample with relationships."""
     headers = {
         "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}"
+        "Content-Type": "application/json"
     }
     update_url = f"{BIOSAMPLE_URL}/{accession}"
-    response = requests.put(update_url, headers=headers, data=json.dumps(updated_json))
+    response = send_request("PUT", update_url, token, session, headers, "update_sample", data=json.dumps(updated_json))
     return response
 
-def update_structured_data(accession, structured_data_json, token):
+def update_structured_data(accession, structured_data_json, token, session=None):
     """Add/update structured data for a given BioSample accession."""
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}",
         "Accept": "application/json"
     }
     url = f"{STRUCTUREDDATA_URL}/{accession}"
-    response = requests.put(url, headers=headers, data=json.dumps(structured_data_json))
+    response = send_request("PUT", url, token, session, headers, "update_structured_data", data=json.dumps(structured_data_json))
     return response
 
-def save_json(data, output_dir, filename):
-    """Save JSON data to a file."""
-    filepath = os.path.join(output_dir, filename)
-    with open(filepath, "w") as f:
-        json.dump(data, f, indent=2)
-    print(f"    Saved: {filepath}")
+def get_sample(accession, token, session=None):
+    """Send GET request to retrieve the current record of a sample."""
+    headers = {
+        "Accept": "application/json"
+    }
+    response = send_request("GET", f"{BIOSAMPLE_URL}/{accession}", token, session, headers, "get_sample")
+    return response
 
-# BioSample types
+def get_structured_data(accession, token, session=None):
+    """Send GET request to retrieve the structured data of a sample."""
+    headers = {
+        "Accept": "application/json"
+    }
+    response = send_request("GET", f"{STRUCTUREDDATA_URL}/{accession}", token, session, headers, "get_structured_data")
+    return response
 
-def process_biosample(input_csv, output_dir, username, password):
-    """Reads a CSV file, obtains a token, processes rows, posts to API, and updates relationships."""
+# Submission journal
 
-    # Check if input file exists
-    if not os.path.exists(input_csv):
-        print(f"Error: The input file '{input_csv}' does not exist.")
-        sys.exit(1)
+class SubmissionJournal:
+    """Append-only log of the outcome of every submission step.
 
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
+    Each line is a JSON record {time, name, step, status, accession, hash}, where step
+    is one of "create", "relationships" or "structured_data" and hash identifies the
+    payload that was sent. Records are flushed and fsync'd as they are written, so the
+    journal survives crashes and walltime kills.
+    """
 
-    # Ensure output/json directory exists
-    json_dir = output_dir / "json"
-    os.makedirs(json_dir, exist_ok=True)
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.resume = resume
+        self.lock = threading.Lock()
+        self.entries, self.hashes = self.replay(path)
+        self.file = open(path, "a")
 
-    # Get API token
-    token = get_token(username, password)
-    print("Successfully obtained authentication token.")
+    @staticmethod
+    def replay(path):
+        """Return the latest outcome of every step and the hashes of the last successful payloads, by sample name."""
+        entries = defaultdict(dict)
+        hashes = {}
+        if not os.path.exists(path):
+            return entries, hashes
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Partially written last line of a crashed run
+                entry = entries[record["name"]]
+                if record.get("accession"):
+                    entry["accession"] = record["accession"]
+                if record["step"] != "create":
+                    entry[record["step"]] = record["status"]
+                if record["status"] == "ok" and record.get("hash"):
+                    hashes[(record["name"], record["step"])] = record["hash"]
+        return entries, hashes
 
-    # Read CSV
-    df = pd.read_csv(input_csv, sep=",")  # Use tab-separated values
+    def completed(self, name):
+        """Return the replayed outcome of a sample when resuming ({} otherwise)."""
+        return self.entries.get(name, {}) if self.resume else {}
 
-    # Ensure "accession" column exists in CSV
-    if "accession" not in df.columns:
-        df["accession"] = ""
+    def last_hash(self, name, step):
+        """Return the hash of the last payload successfully sent for a step."""
+        return self.hashes.get((name, step))
 
-    for index, row in df.iterrows():
-        sample_name = row["name"]
-        accession = row["accession"] if pd.notna(row["accession"]) and row["accession"] != "" else None
+    def record(self, name, step, status, accession=None, hash=None):
+        record = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "name": name,
+            "step": step,
+            "status": status,
+            "accession": accession,
+            "hash": hash
+        }
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
 
-        tax_id = normalize_taxid(row["taxId"])
-        if tax_id is None:
-            print(f"Error: Missing taxId for sample {sample_name}.")
-            sys.exit(1)
+    def close(self):
+        self.file.close()
 
-        # Get timestamp
-        timestamp = datetime.now().strftime("%Y%m%d%H%M")
+# BioSample payloads
 
-        # Construct sample JSON payload (either for submission or update)
-        sample_json = {
-            "name": row["name"],
-            "taxId": tax_id,
-            "release": row["release"],
-            "webinSubmissionAccountId": row["webinSubmissionAccountId"],
-            "characteristics": {}
-        }
+def build_sample_json(row, columns, tax_id):
+    """Build the BioSample payload (without accession or relationships) for a sheet row."""
+    sample_json = {
+        "name": row["name"],
+        "taxId": tax_id,
+        "release": row["release"],
+        "webinSubmissionAccountId": row["webinSubmissionAccountId"],
+        "characteristics": {}
+    }
 
-        # Process characteristics
-        for col in df.columns:
-            if col.startswith("characteristics@"):
-                char_key = col.split("@")[1]  # Extract field name
-                char_value = row[col]
-                if pd.notna(char_value):  # Ignore empty fields
-                    sample_json["characteristics"][char_key] = [{"text": str(char_value)}]
-
-        # Process structured data
-        structured_raw = {}
-        for col in df.columns:
+    # Process characteristics
+    for col in columns:
+        if col.startswith("characteristics@"):
+            char_key = col.split("@")[1]  # Extract field name
+            char_value = row[col]
+            if pd.notna(char_value):  # Ignore empty fields
+                sample_json["characteristics"][char_key] = [{"text": str(char_value)}]
+
+    return sample_json
+
+def build_structured_data(row, columns):
+    """Build the structured data entries declared by data@type@label@valuetype columns."""
+    structured_raw = {}
+    for col in columns:
+        if col.startswith("data@"):
+            parts = col.split("@")
+            if len(parts) == 4:
+                _, data_type, label, value_type = parts
+                structured_raw.setdefault(data_type, {}).setdefault(label, {})[value_type] = row[col]
+
+    # Now format into data_payload with {"metric": ..., "value": ...} structure
+    data_payload = []
+    for data_type, entries in structured_raw.items():
+        content = []
+        for label, pair in entries.items():
+            metric = pair.get("metric")
+            value = pair.get("value")
+            link = pair.get("link")
+            if pd.notna(metric) and pd.notna(value):
+                content.append({
+                    "metric": {"value": metric, "iri": None},
+                    "value": {"value": value, "iri": link if pd.notna(link) else None}
+                })
+        if content:
+            data_payload.append({
+                "domain": None,
+                "webinSubmissionAccountId": row["webinSubmissionAccountId"],
+                "type": data_type,
+                "schema": None,
+                "content": content
+            })
+
+    return data_payload
+
+class PayloadPlan:
+    """Parsed sheet header: the columns that feed the characteristics and structured data of every payload.
+
+    characteristics lists (column, field) pairs of characteristics@field columns, and
+    structured maps each data type and label of data@type@label@valuetype columns to
+    the columns of its metric, value and link.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.characteristics = [(col, col.split("@")[1]) for col in self.columns if col.startswith("characteristics@")]
+        self.structured = {}
+        for col in self.columns:
             if col.startswith("data@"):
                 parts = col.split("@")
                 if len(parts) == 4:
                     _, data_type, label, value_type = parts
-                    structured_raw.setdefault(data_type, {}).setdefault(label, {})[value_type] = row[col]
+                    self.structured.setdefault(data_type, {}).setdefault(label, {})[value_type] = col
+
+def iter_payloads(df, plan=None):
+    """Yield (index, row, sample_json, data_payload) for every row of a sheet, without making any requests.
+
+    Gives the same payloads as build_sample_json and build_structured_data, but the
+    header is parsed once and cells are converted column by column. Rows are plain
+    dictionaries and are yielded one by one, so payloads are built while earlier
+    rows are being submitted.
+    """
+    plan = plan or PayloadPlan(df.columns)
+
+    characteristics = []
+    for col, field in plan.characteristics:
+        characteristics.append((field, df[col].notna().tolist(), df[col].tolist()))
+
+    structured = []
+    for data_type, labels in plan.structured.items():
+        entries = []
+        for value_types in labels.values():
+            if "metric" not in value_types or "value" not in value_types:
+                continue  # Never complete, so never sent
+            metric = df[value_types["metric"]]
+            value = df[value_types["value"]]
+            present = (metric.notna() & value.notna()).tolist()
+            if "link" in value_types:
+                link = df[value_types["link"]].astype(object)
+                links = link.where(link.notna(), None).tolist()
+            else:
+                links = [None] * len(df)
+            entries.append((present, metric.tolist(), value.tolist(), links))
+        structured.append((data_type, entries))
 
-        # Now format into data_payload with {"metric": ..., "value": ...} structure
+    columns = list(df.columns)
+    for i, (index, values) in enumerate(zip(df.index, df.itertuples(index=False, name=None))):
+        start = time.perf_counter()
+        row = dict(zip(columns, values))
+        sample_json = {
+            "name": row["name"],
+            "taxId": normalize_taxid(row["taxId"]),
+            "release": row["release"],
+            "webinSubmissionAccountId": row["webinSubmissionAccountId"],
+            "characteristics": {
+                field: [{"text": str(cells[i])}]
+                for field, present, cells in characteristics if present[i]
+            }
+        }
         data_payload = []
-        for data_type, entries in structured_raw.items():
-            content = []
-            for label, pair in entries.items():
-                metric = pair.get("metric")
-                value = pair.get("value")
-                link = pair.get("link")
-                if pd.notna(metric) and pd.notna(value):
-                    content.append({
-                        "metric": {"value": metric, "iri": None},
-                        "value": {"value": value, "iri": link if pd.notna(link) else None}
-                    })
+        for data_type, entries in structured:
+            content = [
+                {
+                    "metric": {"value": metrics[i], "iri": None},
+                    "value": {"value": cells[i], "iri": links[i]}
+                }
+                for present, metrics, cells, links in entries if present[i]
+            ]
             if content:
                 data_payload.append({
                     "domain": None,
@@ -264,130 +810,562 @@ def process_biosample(input_csv, output_dir, username, password):
                     "schema": None,
                     "content": content
                 })
+        METRICS.observe("build_payload", time.perf_counter() - start)
+        yield index, row, sample_json, data_payload
 
-        # Add or edit BioSample
+def build_updated_json(row, sample_json, accession):
+    """Build the PUT payload of an accessioned sample, including its relationships."""
+    updated_json = {
+        "accession": accession,
+        "name": row["name"],
+        "release": row["release"],
+        "webinSubmissionAccountId": row["webinSubmissionAccountId"],
+        "taxId": sample_json["taxId"],
+        "characteristics": sample_json["characteristics"],
+        "relationships": []
+    }
 
-        if accession:
-            # If accession exists, only update the sample
-            print(f"Updating existing BioSample: {sample_name} ({accession})")
+    # Process child samples
+    if "child_samples" in row and pd.notna(row["child_samples"]):
+        child_accessions = [child.strip() for child in str(row["child_samples"]).split(",") if child.strip()]
+        for child in child_accessions:
+            updated_json["relationships"].append({
+                "source": child,
+                "type": "derived from",
+                "target": accession
+            })
 
-            updated_json = {
-                "accession": accession,
-                "name": row["name"],
-                "release": row["release"],
-                "webinSubmissionAccountId": row["webinSubmissionAccountId"],
-                "taxId": tax_id,
-                "characteristics": sample_json["characteristics"],
-                "relationships": []
-            }
+    # Process parent samples
+    if "parent_sample" in row and pd.notna(row["parent_sample"]):
+        parent = str(row["parent_sample"])
+        updated_json["relationships"].append({
+            "source": accession,
+            "type": "derived from",
+            "target": parent
+        })
 
-            # Process child samples
-            if "child_samples" in row and pd.notna(row["child_samples"]):
-                child_accessions = [child.strip() for child in str(row["child_samples"]).split(",")]
-                for child in child_accessions:
-                    updated_json["relationships"].append({
-                        "source": child,
-                        "type": "derived from",
-                        "target": accession 
-                    })
-
-            # Process parent samples
-            if "parent_sample" in row and pd.notna(row["parent_sample"]):
-                parent = str(row["parent_sample"])
-                updated_json["relationships"].append({
-                    "source": accession, 
-                     "type": "derived from",
-                     "target": parent 
-                })
+    return updated_json
 
-            # API Call: Update existing sample
-            update_response = update_sample(updated_json, accession, token)
+# BioSample diffs
 
-            if update_response.status_code == 200:
-                update_response_json = update_response.json()
-                save_json(update_response_json, json_dir, f"{sample_name}_{timestamp}.json")
-            else:
-                save_json({"error": update_response.text}, json_dir, f"{sample_name}_{timestamp}.json")
+def payload_hash(payload):
+    """Hash a payload independently of key order."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+def normalize_release(release):
+    """Reduce a release date to YYYY-MM-DD, as BioSamples returns it as a full timestamp."""
+    try:
+        return pd.Timestamp(str(release)).strftime("%Y-%m-%d")
+    except ValueError:
+        return str(release)
+
+def normalize_characteristics(characteristics):
+    return {key: sorted(str(value.get("text")) for value in values) for key, values in (characteristics or {}).items()}
+
+def normalize_relationships(relationships):
+    return {(r.get("source"), r.get("type"), r.get("target")) for r in (relationships or [])}
+
+def normalize_structured_data(data):
+    return {
+        entry.get("type"): sorted(
+            (str(item["metric"]["value"]), str(item["value"]["value"]), item["value"].get("iri"))
+            for item in entry.get("content", [])
+        )
+        for entry in (data or [])
+    }
+
+class SubmissionDiff:
+    """Decides whether a payload would change an already accessioned sample.
+
+    In "local" mode a payload is unchanged if its hash matches the last payload
+    successfully sent for the same sample and step, according to the journal.
+    In "remote" mode payloads are compared with the current BioSamples records:
+    a sample is unchanged when its name, taxId, release date, submission account,
+    characteristics, relationships and structured data are already on the record.
+    Characteristics and relationships added by other submissions (e.g. SRA
+    accession) are ignored, so values removed from the sheet are not detected as
+    changes either.
+    """
+
+    def __init__(self, mode, journal=None, remote=None):
+        self.mode = mode
+        self.journal = journal
+        self.remote = remote or {}
+
+    def unchanged(self, name, accession, step, payload):
+        if self.mode == "local":
+            return self.journal is not None and self.journal.last_hash(name, step) == payload_hash(payload)
+        record = self.remote.get(accession, {}).get(step)
+        if record is None:
+            return False
+        if step == "relationships":
+            characteristics = normalize_characteristics(record.get("characteristics"))
+            return (
+                record.get("name") == payload["name"]
+                and record.get("taxId") == payload["taxId"]
+                and normalize_release(record.get("release")) == normalize_release(payload["release"])
+                and record.get("webinSubmissionAccountId", payload["webinSubmissionAccountId"]) == payload["webinSubmissionAccountId"]
+                and all(characteristics.get(key) == values for key, values in normalize_characteristics(payload["characteristics"]).items())
+                and normalize_relationships(payload["relationships"]) <= normalize_relationships(record.get("relationships"))
+            )
+        current = normalize_structured_data(record)
+        return all(current.get(data_type) == content for data_type, content in normalize_structured_data(payload).items())
+
+def fetch_remote_records(accessions, token, session=None, workers=1, structured_data=False):
+    """Retrieve the current records (and optionally structured data) of many samples concurrently."""
+
+    def fetch(accession):
+        record = {}
+        response = get_sample(accession, token, session)
+        if response.status_code == 200:
+            record["relationships"] = response.json()
+        if structured_data:
+            response = get_structured_data(accession, token, session)
+            if response.status_code == 200:
+                record["structured_data"] = response.json().get("data", [])
+        return record
+
+    accessions = list(dict.fromkeys(accessions))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return dict(zip(accessions, executor.map(fetch, accessions)))
+
+def prepare_diff(mode, dfs, journal, token, session=None, workers=1):
+    """Set up a SubmissionDiff for the given mode (None disables diffing)."""
+    if mode is None:
+        return None
+    if mode == "local":
+        return SubmissionDiff(mode, journal=journal)
+    accessions = [accession for df in dfs for accession in df["accession"] if pd.notna(accession) and accession != ""]
+    structured_data = any(col.startswith("data@") for df in dfs for col in df.columns)
+    print(f"Fetching {len(accessions)} existing BioSample records")
+    return SubmissionDiff(mode, remote=fetch_remote_records(accessions, token, session, workers, structured_data))
+
+# BioSample types
+
+def submit_biosample_row(row, token, responses, session=None, journal=None, diff=None, payloads=None, registry=None):
+    """Create or update the BioSample of one sheet row, keeping the order POST > PUT > structured data.
+
+    payloads is the (sample_json, data_payload) pair of the row, as built by
+    iter_payloads; they are built from the row when not given.
+    Steps already completed according to the journal, and updates that would not
+    change the sample according to the diff, are skipped. Samples without an
+    accession are looked up by name in the registry before being created, and every
+    accessioned sample is registered.
+    Returns the accession of a sample that had none in the sheet (newly created or
+    found in the registry, otherwise None) and the outcome of the row: "created",
+    "updated", "unchanged" or "failed".
+    """
+    sample_name = row["name"]
+    webin = row["webinSubmissionAccountId"]
+    accession = row["accession"] if pd.notna(row["accession"]) and row["accession"] != "" else None
+    created_accession = None
+    found_accession = None
+    completed = journal.completed(sample_name) if journal else {}
+    outcome = "unchanged"
+
+    tax_id = normalize_taxid(row["taxId"])
+    if tax_id is None:
+        print(f"Error: Missing taxId for sample {sample_name}.")
+        sys.exit(1)
+
+    # Construct sample JSON payload (either for submission or update)
+    if payloads is None:
+        with METRICS.span("build_payload"):
+            payloads = build_sample_json(row, row.index, tax_id), build_structured_data(row, row.index)
+    sample_json, data_payload = payloads
+
+    # Add or edit BioSample
+    registered = registry.lookup(webin, sample_name) if registry and not accession and not completed.get("accession") else None
+
+    if not accession and completed.get("accession"):
+        # Sample was already created by a previous (interrupted) run
+        accession = completed["accession"]
+        created_accession = accession
+        outcome = "created"
+        print(f"Resuming BioSample: {sample_name} ({accession})")
+
+    elif accession:
+        # If accession exists, only update the sample
+        print(f"Updating existing BioSample: {sample_name} ({accession})")
+
+    elif registered:
+        # Sample was created before, e.g. from another copy of the sheet
+        accession = registered
+        found_accession = accession
+        print(f"Updating registered BioSample: {sample_name} ({accession})")
+
+    else:
+        # If accession does not exist, create a new BioSample
+        print(f"Creating new BioSample: {sample_name}")
+
+        response = post_sample(sample_json, token, session)
+
+        #If initial request is successful
+        if response.status_code == 201:  # Success
+            response_json = response.json()
+            accession = response_json.get("accession")
+            created_accession = accession
+            outcome = "created"
+            if journal:
+                journal.record(sample_name, "create", "ok", accession)
+            if registry:
+                registry.record(webin, sample_name, accession)
 
+        #If initial request yields an error
         else:
-            # If accession does not exist, create a new BioSample
-            print(f"Creating new BioSample: {sample_name}")
-
-            response = post_sample(sample_json, token)
-
-            #If initial request is successful
-            if response.status_code == 201:  # Success
-                response_json = response.json()
-                accession = response_json.get("accession")
-                df["accession"] = df["accession"].astype(str)
-                df.at[index, "accession"] = accession  # Store accession in DataFrame
-
-                # Save original response JSON
-                #save_json(response_json, output_dir, f"{sample_name}.json")
-
-                # Now update the sample with relationships
-                updated_json = {
-                    "accession": accession,
-                    "name": row["name"],
-                    "release": row["release"],
-                    "webinSubmissionAccountId": row["webinSubmissionAccountId"],
-                    "taxId": tax_id,
-                    "characteristics": sample_json["characteristics"],
-                    "relationships": []
-                }
+            responses.save(sample_name, "error", {"error": response.text})
+            if journal:
+                journal.record(sample_name, "create", "failed")
+            return None, "failed"
 
-                # Process child samples
-                if "child_samples" in row and pd.notna(row["child_samples"]):
-                    child_accessions = [child.strip() for child in str(row["child_samples"]).split(",") if child.strip()]
-                    for child in child_accessions:
-                        updated_json["relationships"].append({
-                            "source": child,
-                            "type": "derived from",
-                            "target": accession
-                        })
-
-                # Process parent samples
-                if "parent_sample" in row and pd.notna(row["parent_sample"]):
-                    parent = str(row["parent_sample"])
-                    updated_json["relationships"].append({
-                        "source": accession, 
-                        "type": "derived from",
-                        "target": parent 
-                    })
-
-                # Second API Call: Update sample with relationships
-                update_response = update_sample(updated_json, accession, token)
-
-                if update_response.status_code == 200:
-                    print(f"    Updating relationships")
-                    update_response_json = update_response.json()
-                    save_json(update_response_json, json_dir, f"{sample_name}_{timestamp}.json")
-                else:
-                    print(f"    Relationship update failed")
-                    save_json({"error": update_response.text}, json_dir, f"{sample_name}_{timestamp}.json")
+    sent_hash = None
 
-            #If initial request yields an error
+    # Update the sample with relationships
+    updated_json = build_updated_json(row, sample_json, accession)
+    if completed.get("relationships") == "ok":
+        print(f"    Relationships already updated")
+    elif not created_accession and diff and diff.unchanged(sample_name, accession, "relationships", updated_json):
+        print(f"    Sample unchanged")
+    else:
+        update_response = update_sample(updated_json, accession, token, session)
+
+        if update_response.status_code == 200:
+            if created_accession:
+                print(f"    Updating relationships")
             else:
-                 save_json({"error": response.text}, json_dir, f"{sample_name}_{timestamp}.json")
-
-        # Add or edit Structured data
-        if data_payload:
-            print(f"    Updating structured data")
-            timestamp_iso = datetime.utcnow().isoformat(timespec='microseconds') + "Z"
-            structured_payload = {
-                "accession": accession,
-                "create": timestamp_iso,
-                "update": timestamp_iso,
-                "data": data_payload
+                outcome = "updated"
+            update_response_json = update_response.json()
+            responses.save(sample_name, "sample", update_response_json, accession)
+            sent_hash = payload_hash(updated_json)
+        else:
+            if created_accession:
+                print(f"    Relationship update failed")
+            outcome = "failed"
+            responses.save(sample_name, "error", {"error": update_response.text}, accession)
+        if journal:
+            journal.record(sample_name, "relationships", "ok" if update_response.status_code == 200 else "failed", accession, payload_hash(updated_json))
+
+    # Add or edit Structured data
+    if data_payload and completed.get("structured_data") == "ok":
+        print(f"    Structured data already updated")
+    elif data_payload and not created_accession and diff and diff.unchanged(sample_name, accession, "structured_data", data_payload):
+        print(f"    Structured data unchanged")
+    elif data_payload:
+        print(f"    Updating structured data")
+        timestamp_iso = datetime.utcnow().isoformat(timespec='microseconds') + "Z"
+        structured_payload = {
+            "accession": accession,
+            "create": timestamp_iso,
+            "update": timestamp_iso,
+            "data": data_payload
+        }
+        structured_response = update_structured_data(accession, structured_payload, token, session)
+        if structured_response.status_code in [200, 201]:
+            if outcome == "unchanged":
+                outcome = "updated"
+            responses.save(sample_name, "structured_data", structured_response.json(), accession)
+        else:
+            outcome = "failed"
+            print(f"❌ Structured data update failed for {accession}: {structured_response.status_code}")
+            responses.save(sample_name, "structured_error", {"error": structured_response.text}, accession)
+        if journal:
+            journal.record(sample_name, "structured_data", "ok" if structured_response.status_code in [200, 201] else "failed", accession, payload_hash(data_payload))
+
+    if registry:
+        registry.record(webin, sample_name, accession, sent_hash)
+
+    return created_accession or found_accession, outcome
+
+def submit_biosample_rows(rows, token, responses, workers=1, session=None, journal=None, diff=None, registry=None):
+    """Submit (key, row, payloads) items, running up to `workers` rows concurrently.
+
+    Each row keeps its own order of requests; rows are independent of each other.
+    rows can be a generator: rows are handed to the workers as they are produced.
+    Returns a dictionary of row key to accession, for rows that had none in the
+    sheet, and the number of rows per outcome.
+    """
+    if session is None:
+        session = create_session(workers)
+
+    if workers <= 1:
+        results = {key: submit_biosample_row(row, token, responses, session, journal, diff, payloads, registry) for key, row, payloads in rows}
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                key: executor.submit(submit_biosample_row, row, token, responses, session, journal, diff, payloads, registry)
+                for key, row, payloads in rows
             }
-            structured_response = update_structured_data(accession, structured_payload, token)
-            if structured_response.status_code in [200, 201]:
-                save_json(structured_response.json(), json_dir, f"{sample_name}_data_{timestamp}.json")
-            else:
-                print(f"❌ Structured data update failed for {accession}: {structured_response.status_code}")
-                save_json({"error": structured_response.text}, json_dir, f"{sample_name}_structured_error_{timestamp}.json")
+            results = {key: future.result() for key, future in futures.items()}
+
+    new_accessions = {key: accession for key, (accession, _) in results.items() if accession}
+    outcomes = Counter(outcome for _, outcome in results.values())
+    return new_accessions, outcomes
+
+def report_outcomes(outcomes):
+    for outcome, count in outcomes.items():
+        METRICS.increment("rows", count, outcome=outcome)
+    print(f"Samples created: {outcomes['created']}, updated: {outcomes['updated']}, unchanged: {outcomes['unchanged']}, failed: {outcomes['failed']}")
+
+def process_biosample(input_csv, output_dir, username, password, workers=1, resume=False, skip_unchanged=None, session=None, chunksize=None, response_format="archive", registry=None):
+    """Reads a CSV file, obtains a token, processes rows, posts to API, and updates relationships.
+
+    With chunksize, the sheet is read, submitted and written to the updated CSV in
+    chunks of that many rows, so memory use stays flat however large the sheet is.
+    registry is the path of the sample registry (None for the default, False to
+    disable it).
+    """
+
+    # Check if input file exists
+    if not os.path.exists(input_csv):
+        print(f"Error: The input file '{input_csv}' does not exist.")
+        sys.exit(1)
+
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
 
-    # Save updated CSV with accession numbers
+    # Store API responses in output/responses (or one file each in output/json)
+    responses = open_response_store(output_dir, response_format)
+    METRICS.reset()
+    RATE_CONTROLLER.reset(workers)
+
+    # Get API token, shared by all workers and renewed when needed
+    token = TokenManager(username, password)
+    token.get()
+    print("Successfully obtained authentication token.")
+
+    # Journal every step, replaying earlier outcomes when resuming
+    journal = SubmissionJournal(output_dir / "journal.jsonl", resume)
+    registry = SampleRegistry(registry, EBI_URL) if registry is not False else None
+
+    # Submit rows, sharing one pool of keep-alive connections across workers
+    session = session or create_session(workers)
     updated_csv_path = os.path.join(output_dir, "updated_" + os.path.basename(input_csv))
-    df.to_csv(updated_csv_path, sep=",", index=False)
+    outcomes = Counter()
+    plan = None
+    for number, df in enumerate(read_metadata(input_csv, chunksize)):
+
+        # Ensure "accession" column exists in CSV
+        if "accession" not in df.columns:
+            df["accession"] = ""
+
+        # Related samples created in earlier runs may be given by name
+        resolve_registered(df, registry)
+
+        # Parse the header once; payloads are then built while earlier rows are submitted
+        plan = plan or PayloadPlan(df.columns)
+        rows = ((index, row, (sample_json, data_payload)) for index, row, sample_json, data_payload in iter_payloads(df, plan))
+
+        diff = prepare_diff(skip_unchanged, [df], journal, token, session, workers)
+        new_accessions, chunk_outcomes = submit_biosample_rows(rows, token, responses, workers, session, journal, diff, registry)
+        outcomes.update(chunk_outcomes)
+
+        # Store new accessions in DataFrame
+        if new_accessions:
+            df["accession"] = df["accession"].astype(object)
+            for index, accession in new_accessions.items():
+                df.at[index, "accession"] = accession
+
+        # Save updated CSV with accession numbers, appending each chunk once it is done
+        df.to_csv(updated_csv_path, sep=",", index=False, header=number == 0, mode="w" if number == 0 else "a")
+    journal.close()
+    responses.close()
+    if registry:
+        registry.close()
+    report_outcomes(outcomes)
+    METRICS.write(output_dir, throughput={"rows": sum(outcomes.values()), "bytes": METRICS.counter("bytes_sent") + METRICS.counter("bytes_received")})
     print(f"Updated CSV (with accession numbers) saved: {updated_csv_path}")
+
+# BioSample hierarchies
+
+def split_references(value):
+    """Split a comma-separated child_samples/parent_sample cell into its references."""
+    if pd.isna(value):
+        return []
+    return [reference.strip() for reference in str(value).split(",") if reference.strip()]
+
+# BioSample accessions, as opposed to sample names
+ACCESSION_PATTERN = re.compile(r"^SAM(EA|N|D)\d+$")
+MAX_UNRESOLVED = 20  # Unresolved names printed
+
+def resolve_registered(df, registry, names=()):
+    """Replace the sample names in child_samples and parent_sample by their registered accessions.
+
+    References that are accessions, or names in `names` (samples of the input sheets,
+    resolved while they are submitted), are kept. Any other name is looked up in the
+    registry under the Webin account of its row, so samples created in earlier runs
+    can be referenced by name. Exits if a name cannot be resolved.
+    """
+    unresolved = []
+    for column in ["child_samples", "parent_sample"]:
+        if column not in df.columns:
+            continue
+        for index, value in df[column].items():
+            references = split_references(value)
+            if all(ACCESSION_PATTERN.match(reference) or reference in names for reference in references):
+                continue
+            webin = df.at[index, "webinSubmissionAccountId"]
+            for position, reference in enumerate(references):
+                if ACCESSION_PATTERN.match(reference) or reference in names:
+                    continue
+                accession = registry.lookup(webin, reference) if registry else None
+                if accession is None:
+                    unresolved.append(reference)
+                else:
+                    references[position] = accession
+            df.at[index, column] = ",".join(references)
+    if unresolved:
+        unresolved = list(dict.fromkeys(unresolved))
+        shown = ", ".join(unresolved[:MAX_UNRESOLVED]) + (f" and {len(unresolved) - MAX_UNRESOLVED} more" if len(unresolved) > MAX_UNRESOLVED else "")
+        print(f"Error: {len(unresolved)} related samples are neither accessions, nor in the input tables, nor in the sample registry: {shown}")
+        print("Use their accessions, pass their tables to -i as well, or submit them first" + ("" if registry else " without --no-registry") + ".")
+        sys.exit(1)
+
+def build_biosample_waves(sheets):
+    """Order the rows of several sheets into waves of the derived-from graph.
+
+    References in child_samples and parent_sample can be accessions or names of
+    samples in any of the sheets. A row depends on the rows it references by name,
+    so every wave only contains rows whose references were created in earlier waves.
+    Returns a list of waves, each a list of (sheet_index, row_index) keys.
+    """
+    names = {}
+    for sheet_index, df in enumerate(sheets):
+        for row_index, name in df["name"].items():
+            if name in names:
+                print(f"Error: Sample name '{name}' appears more than once in the input tables.")
+                sys.exit(1)
+            names[name] = (sheet_index, row_index)
+
+    dependencies = {}
+    dependants = defaultdict(list)
+    for sheet_index, df in enumerate(sheets):
+        for row_index, row in df.iterrows():
+            key = (sheet_index, row_index)
+            references = []
+            for column in ["child_samples", "parent_sample"]:
+                if column in df.columns:
+                    references += split_references(row[column])
+            dependencies[key] = {names[reference] for reference in references if reference in names and names[reference] != key}
+            for dependency in dependencies[key]:
+                dependants[dependency].append(key)
+
+    # Kahn's algorithm, one wave per level
+    pending = {key: len(deps) for key, deps in dependencies.items()}
+    wave = [key for key, count in pending.items() if count == 0]
+    waves = []
+    while wave:
+        waves.append(wave)
+        next_wave = []
+        for key in wave:
+            for dependant in dependants[key]:
+                pending[dependant] -= 1
+                if pending[dependant] == 0:
+                    next_wave.append(dependant)
+        wave = next_wave
+
+    if sum(len(wave) for wave in waves) < len(dependencies):
+        cyclic = [sheets[s].at[i, "name"] for (s, i), count in pending.items() if count > 0]
+        print(f"Error: Circular sample relationships between: {', '.join(map(str, cyclic))}. Declare each relationship on one side only.")
+        sys.exit(1)
+
+    return waves
+
+def process_biosample_hierarchy(input_csvs, output_dir, username, password, workers=1, resume=False, skip_unchanged=None, response_format="archive", registry=None):
+    """Submits several related sheets in one run, creating each level of the hierarchy in parallel waves.
+
+    Sample names used in child_samples or parent_sample are replaced by the accessions
+    obtained in earlier waves, so each sample is created and linked with a single
+    relationship update. Names of samples outside the input tables are looked up in
+    the registry. registry is as in process_biosample.
+    """
+
+    # Check if input files exist
+    for input_csv in input_csvs:
+        if not os.path.exists(input_csv):
+            print(f"Error: The input file '{input_csv}' does not exist.")
+            sys.exit(1)
+
+    # Store API responses in output/responses (or one file each in output/json)
+    responses = open_response_store(output_dir, response_format)
+    METRICS.reset()
+    RATE_CONTROLLER.reset(workers)
+
+    # Read CSVs
+    sheets = []
+    for input_csv in input_csvs:
+        df = next(read_metadata(input_csv))
+        if "accession" not in df.columns:
+            df["accession"] = ""
+        df["accession"] = df["accession"].astype(object)
+        for column in ["child_samples", "parent_sample"]:
+            if column in df.columns:
+                df[column] = df[column].astype(object)
+        sheets.append(df)
+
+    waves = build_biosample_waves(sheets)
+    print(f"Submitting {sum(len(wave) for wave in waves)} samples in {len(waves)} waves.")
+
+    # Related samples outside the input tables may be given by name if they are registered
+    registry = SampleRegistry(registry, EBI_URL) if registry is not False else None
+    names = {name for df in sheets for name in df["name"]}
+    for df in sheets:
+        resolve_registered(df, registry, names)
+
+    # Get API token, shared by all workers and renewed when needed
+    token = TokenManager(username, password)
+    token.get()
+    print("Successfully obtained authentication token.")
+
+    # Accessions known so far, by sample name
+    resolved = {}
+    for df in sheets:
+        for name, accession in zip(df["name"], df["accession"]):
+            if pd.notna(accession) and accession != "":
+                resolved[name] = accession
+
+    # Payloads do not depend on relationships, so they are all built up front
+    payloads = {
+        (sheet_index, index): (sample_json, data_payload)
+        for sheet_index, df in enumerate(sheets)
+        for index, _, sample_json, data_payload in iter_payloads(df)
+    }
+
+    journal = SubmissionJournal(output_dir / "journal.jsonl", resume)
+    session = create_session(workers)
+    diff = prepare_diff(skip_unchanged, sheets, journal, token, session, workers)
+    outcomes = Counter()
+    for number, wave in enumerate(waves, start=1):
+        print(f"Wave {number}/{len(waves)}: {len(wave)} samples")
+        rows = []
+        for sheet_index, row_index in wave:
+            df = sheets[sheet_index]
+            missing = []
+            for column in ["child_samples", "parent_sample"]:
+                if column not in df.columns:
+                    continue
+                references = split_references(df.at[row_index, column])
+                missing += [reference for reference in references if reference in names and reference not in resolved]
+                if references:
+                    df.at[row_index, column] = ",".join(resolved.get(reference, reference) for reference in references)
+            if missing:
+                print(f"Skipping {df.at[row_index, 'name']}: related samples were not created ({', '.join(missing)})")
+                continue
+            rows.append(((sheet_index, row_index), df.loc[row_index], payloads.pop((sheet_index, row_index))))
+
+        new_accessions, wave_outcomes = submit_biosample_rows(rows, token, responses, workers, session, journal, diff, registry)
+        outcomes.update(wave_outcomes)
+        for (sheet_index, row_index), accession in new_accessions.items():
+            sheets[sheet_index].at[row_index, "accession"] = accession
+            resolved[sheets[sheet_index].at[row_index, "name"]] = accession
+    journal.close()
+    responses.close()
+    if registry:
+        registry.close()
+    report_outcomes(outcomes)
+    METRICS.write(output_dir, throughput={"rows": sum(outcomes.values()), "bytes": METRICS.counter("bytes_sent") + METRICS.counter("bytes_received")})
+
+    # Save updated CSVs with accession numbers
+    for input_csv, df in zip(input_csvs, sheets):
+        updated_csv_path = os.path.join(output_dir, "updated_" + os.path.basename(input_csv))
+        df.to_csv(updated_csv_path, sep=",", index=False)
+        print(f"Updated CSV (with accession numbers) saved: {updated_csv_path}")
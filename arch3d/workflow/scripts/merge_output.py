@@ -1,46 +1,151 @@
+import os
 import sys
+import csv
+import json
+import shutil
+import argparse
 import xml.etree.ElementTree as ET
-import pandas as pd
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-def extract_data(xml_file):
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
+# Make the arch3d package importable from the Snakemake environment
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from arch3d.registry import SampleRegistry
+
+COLUMNS = ["data", "sample", "run_accession", "experiment_accession", "sample_accession", "biosample_accession", "submission_accession"]
 
+def extract_data(xml_file):
     data = Path(xml_file).parent.name  # Extracts sample folder name (e.g., 'M302118b')
 
-    # Extract values from XML
-    experiment_accession = root.find(".//EXPERIMENT").attrib.get("accession", "N/A")
-    run_accession = root.find(".//RUN").attrib.get("accession", "N/A")
+    record = {column: "N/A" for column in COLUMNS}
+    record["data"] = data
+
+    # Stream the receipt, keeping the first element of each kind
+    seen = set()
+    parents = []
+    for event, element in ET.iterparse(xml_file, events=("start", "end")):
+        if event == "end":
+            parents.pop()
+            element.clear()
+            continue
+        tag = element.tag
+        if tag == "EXPERIMENT" and tag not in seen:
+            record["experiment_accession"] = element.attrib.get("accession", "N/A")
+        elif tag == "RUN" and tag not in seen:
+            record["run_accession"] = element.attrib.get("accession", "N/A")
+        elif tag == "SAMPLE" and tag not in seen:
+            record["sample_accession"] = element.attrib.get("accession", "N/A")
+            record["sample"] = element.attrib.get("alias", "N/A")
+        elif tag == "EXT_ID" and parents and parents[-1] == "SAMPLE" and element.attrib.get("type") == "biosample" and "biosample" not in seen:
+            record["biosample_accession"] = element.attrib.get("accession", "N/A")
+            seen.add("biosample")
+        elif tag == "SUBMISSION" and tag not in seen:
+            record["submission_accession"] = element.attrib.get("accession", "N/A")
+        seen.add(tag)
+        parents.append(tag)
+
+    return record
+
+def read_manifest(manifest):
+    with open(manifest, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def write_records(writer, records):
+    for record in records:
+        writer.writerow([record[column] for column in COLUMNS])
+
+def merge(receipts, output_file, cache_dir, workers=1):
+    """Merge receipts into output_file, only parsing receipts that are new or changed since the last merge.
+
+    The merged table and an index of receipt sizes and mtimes are kept in cache_dir,
+    which survives the removal of output_file by Snakemake before each run.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_table = os.path.join(cache_dir, "data_submission.tsv")
+    index_file = os.path.join(cache_dir, "index.json")
+
+    index = {}
+    if os.path.exists(index_file) and os.path.exists(cache_table):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+
+    # Find new, changed and removed receipts
+    stats = {}
+    for receipt in receipts:
+        stat = os.stat(receipt)
+        stats[receipt] = [stat.st_mtime_ns, stat.st_size]
+    pending = [receipt for receipt in receipts if index.get(receipt, {}).get("stat") != stats[receipt]]
+    pending_set = set(pending)
+    outdated = {index[receipt]["data"] for receipt in index if receipt not in stats or receipt in pending_set}
+
+    if workers <= 1:
+        records = [extract_data(receipt) for receipt in pending]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            records = list(executor.map(extract_data, pending, chunksize=64))
+    print(f"Merging {len(records)} new or changed receipts ({len(receipts) - len(pending)} unchanged)")
 
-    sample_element = root.find(".//SAMPLE")
-    sample_accession = sample_element.attrib.get("accession", "N/A") if sample_element is not None else "N/A"
-    sample = sample_element.attrib.get("alias", "N/A") if sample_element is not None else "N/A"
+    # Stream the previous table, dropping rows of changed or removed receipts. Rows of
+    # pending receipts are dropped too: a merge interrupted before the index was saved
+    # may already have written them.
+    outdated |= {record["data"] for record in records}
+    tmp_table = f"{cache_table}.tmp"
+    with open(tmp_table, "w", newline="") as out:
+        writer = csv.writer(out, delimiter="\t", lineterminator=os.linesep)
+        writer.writerow(COLUMNS)
+        if os.path.exists(cache_table):
+            with open(cache_table, "r", newline="") as f:
+                reader = csv.reader(f, delimiter="\t")
+                next(reader, None)
+                for row in reader:
+                    if row[0] not in outdated:
+                        writer.writerow(row)
+        write_records(writer, records)
+    os.replace(tmp_table, cache_table)
 
-    biosample_element = root.find(".//SAMPLE/EXT_ID[@type='biosample']")
-    biosample_accession = biosample_element.attrib.get("accession", "N/A") if biosample_element is not None else "N/A"
+    index = {receipt: index[receipt] for receipt in receipts if receipt in index and receipt not in pending_set}
+    index.update({receipt: {"stat": stats[receipt], "data": record["data"]} for receipt, record in zip(pending, records)})
+    tmp_index = f"{index_file}.tmp"
+    with open(tmp_index, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_index, index_file)
 
-    submission_element = root.find(".//SUBMISSION")
-    submission_accession = submission_element.attrib.get("accession", "N/A") if submission_element is not None else "N/A"
+    shutil.copyfile(cache_table, output_file)
 
-    return {
-        "data": data,
-        "sample": sample,
-        "run_accession": run_accession,
-        "experiment_accession": experiment_accession,
-        "sample_accession": sample_accession,
-        "biosample_accession": biosample_accession,
-        "submission_accession": submission_accession,
-    }
+def register_samples(table, webin, registry_file=None):
+    """Register the sample alias and BioSample accession of every row of a merged table."""
+    with open(table, "r", newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        entries = [
+            (webin, row["sample"], row["biosample_accession"], None, "ena")
+            for row in reader
+            if row["sample"] != "N/A" and row["biosample_accession"] != "N/A"
+        ]
+    # ena-upload-cli always submits to the production endpoint
+    registry = SampleRegistry(registry_file)
+    registry.record_many(entries)
+    registry.close()
+    print(f"Registered {len(entries)} samples in {registry.path}")
 
 def main():
-    input_files = sys.argv[1:-1]  # All input XML files
-    output_file = sys.argv[-1]    # Last argument is the output file
+    parser = argparse.ArgumentParser(description="Merge ENA receipts into a single table")
+    parser.add_argument("paths", nargs="+", help="Receipt files (optional if --manifest is given) followed by the output file")
+    parser.add_argument("--manifest", help="File listing one receipt path per line")
+    parser.add_argument("--cache", help="Directory for the incremental merge state. Default is .merge_output next to the output file")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes parsing receipts")
+    parser.add_argument("--webin", help="Webin account of the receipts. If given, their samples are added to the sample registry")
+    parser.add_argument("--registry", help="Sample registry file. Default is ~/.local/share/arch3d/registry.sqlite")
+    args = parser.parse_args()
 
-    records = [extract_data(xml) for xml in input_files]
+    input_files = args.paths[:-1]  # Receipt XML files given as arguments
+    output_file = args.paths[-1]   # Last argument is the output file
+    if args.manifest:
+        input_files += read_manifest(args.manifest)
+    cache_dir = args.cache or os.path.join(os.path.dirname(os.path.abspath(output_file)), ".merge_output")
 
-    df = pd.DataFrame(records)
-    df.to_csv(output_file, sep="\t", index=False)
+    merge(input_files, output_file, cache_dir, args.workers)
+    if args.webin:
+        register_samples(output_file, args.webin, args.registry)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,38 @@
+import sys
+import csv
+import xml.etree.ElementTree as ET
+
+def get_sample_alias(experiment_checklist):
+    with open(experiment_checklist, "r", newline="") as f:
+        row = next(csv.DictReader(f, delimiter="\t"))
+    return row["sample_alias"]
+
+def split_receipt(batch_receipt, alias, sample_alias):
+    """Keep the elements of a batch receipt that belong to a single sample."""
+    root = ET.parse(batch_receipt).getroot()
+
+    receipt = ET.Element(root.tag, root.attrib)
+    for element in root:
+        if element.tag in ("RUN", "EXPERIMENT"):
+            if element.attrib.get("alias") == alias:
+                receipt.append(element)
+        elif element.tag == "SAMPLE":
+            if element.attrib.get("alias") == sample_alias:
+                receipt.append(element)
+        else:
+            # SUBMISSION, MESSAGES and ACTIONS are shared by the whole batch
+            receipt.append(element)
+
+    return ET.ElementTree(receipt)
+
+def main():
+    batch_receipt = sys.argv[1]         # Receipt of the batch upload
+    alias = sys.argv[2]                 # Sample (run/experiment alias)
+    experiment_checklist = sys.argv[3]  # Experiment checklist of the sample
+    output_file = sys.argv[4]           # Per-sample receipt
+
+    tree = split_receipt(batch_receipt, alias, get_sample_alias(experiment_checklist))
+    tree.write(output_file, encoding="UTF-8", xml_declaration=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import os
+import sys
+import time
+import datetime
+import subprocess
+
+def run_timed(command, benchmark_file, cwd=None, stdout=None):
+    """Run a command, writing its wall time, peak memory and CPU time as a Snakemake-style benchmark file.
+
+    Returns the exit code of the command (negative if it was killed by a signal).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(benchmark_file)), exist_ok=True)
+    start = time.time()
+    process = subprocess.Popen(command, cwd=cwd, stdout=stdout, stderr=subprocess.STDOUT if stdout else None)
+    # wait4 reports the peak memory and CPU time of this command alone
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+
+    with open(benchmark_file, "w") as f:
+        f.write("s\th:m:s\tmax_rss\tcpu_time\n")
+        f.write(f"{seconds:.4f}\t{datetime.timedelta(seconds=int(seconds))}\t{usage.ru_maxrss / 1024:.2f}\t{usage.ru_utime + usage.ru_stime:.2f}\n")
+
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+def main():
+    benchmark_file = sys.argv[1]  # Benchmark file to write
+    command = sys.argv[2:]        # Command to run, with its arguments
+
+    code = run_timed(command, benchmark_file)
+    sys.exit(code if code >= 0 else 128 - code)
+
+if __name__ == "__main__":
+    main()
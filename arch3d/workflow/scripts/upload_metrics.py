@@ -0,0 +1,67 @@
+import os
+import sys
+import csv
+import json
+from pathlib import Path
+
+# Make the arch3d package importable from the Snakemake environment
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+from arch3d.metrics import Metrics
+from arch3d.resources import append_history
+
+def parse_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None  # Snakemake writes NA or - for jobs too short to measure
+
+def read_benchmark(benchmark_file):
+    """Read the last line of a Snakemake benchmark file (s, max_rss, io_out, ...)."""
+    with open(benchmark_file, "r", newline="") as f:
+        rows = list(csv.DictReader(f, delimiter="\t"))
+    return rows[-1]
+
+def write_upload_metrics(jobs, output_dir):
+    """Summarise the benchmark files of upload jobs ({job: {"benchmark": ..., "data": [...]}})."""
+    metrics = Metrics()
+    total_bytes = 0
+    started = None
+    history = []
+    for job, info in jobs.items():
+        benchmark = read_benchmark(info["benchmark"])
+        seconds = float(benchmark["s"])
+        size = sum(os.path.getsize(path) for path in info["data"] if os.path.exists(path))
+        total_bytes += size
+
+        # Job history for sizing the resources of future upload jobs
+        history.append({
+            "id": f"{os.path.abspath(info['benchmark'])}:{os.stat(info['benchmark']).st_mtime_ns}",
+            "size_mb": size / 1024 / 1024,
+            "seconds": seconds,
+            "max_rss_mb": parse_number(benchmark.get("max_rss"))
+        })
+
+        metrics.observe("upload_job", seconds)
+        metrics.increment("upload_jobs")
+        metrics.increment("bytes_sent", size)
+
+        # The upload phase started when the earliest job did
+        job_started = os.path.getmtime(info["benchmark"]) - seconds
+        started = job_started if started is None else min(started, job_started)
+
+    if started is not None:
+        metrics.started = started
+    metrics.write(output_dir, "upload", throughput={"bytes": total_bytes, "jobs": len(jobs)})
+    append_history(history)
+
+def main():
+    jobs_file = sys.argv[1]    # JSON of job name to benchmark file and uploaded data files
+    output_dir = sys.argv[2]   # Directory for upload.json and upload.prom
+
+    with open(jobs_file, "r") as f:
+        jobs = json.load(f)
+
+    write_upload_metrics(jobs, output_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+import pandas as pd
+from pathlib import Path
+from collections import Counter
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from arch3d import utils
+from arch3d.mock_ebi import MockEBIServer
+
+######
+# End-to-end throughput of BioSample submission against the local mock EBI service
+######
+
+FIXTURES = [
+    REPO_DIR / "test" / "animal" / "animal.tsv",
+    REPO_DIR / "test" / "cryosection" / "cryosection.tsv",
+]
+
+def synthetic_sheet(rows: int, output_csv: str):
+    """Write a sheet of new samples by cycling over the animal and cryosection fixtures."""
+    fixtures = pd.concat([pd.read_csv(fixture, sep="\t") for fixture in FIXTURES], ignore_index=True)
+    fixtures = fixtures.drop(columns=["accession", "child_samples"], errors="ignore")
+    df = fixtures.iloc[[i % len(fixtures) for i in range(rows)]].reset_index(drop=True)
+    df["name"] = [f"{name}_{i}" for i, name in enumerate(df["name"])]
+    df.to_csv(output_csv, sep=",", index=False)
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+def run_benchmark(rows: int, workers: int, server: MockEBIServer, workdir: Path):
+    sheet = workdir / f"sheet_{rows}.csv"
+    synthetic_sheet(rows, sheet)
+
+    # Record client-side latency and status of every request
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def record(response, *args, **kwargs):
+        with lock:
+            latencies.append(response.elapsed.total_seconds())
+            statuses[response.status_code] += 1
+
+    session = utils.create_session(workers)
+    session.hooks["response"].append(record)
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        utils.process_biosample(str(sheet), workdir / f"output_{rows}_{workers}", "Webin-00000", "benchmark", workers, session=session, registry=False)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "rows": rows,
+        "workers": workers,
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed,
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "statuses": dict(statuses),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BioSample submission throughput against a local mock EBI service")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000], help="Sheet sizes to benchmark. Default is 1000 10000 100000")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8], help="Worker counts to benchmark. Default is 1 8")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latency added by the mock service, in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random latency added on top, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--capacity", type=int, default=None, help="Requests the mock service serves concurrently; further ones are answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After (seconds) sent with 429 responses")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for injected failures")
+    args = parser.parse_args()
+
+    server = MockEBIServer(latency=args.latency / 1000, jitter=args.jitter / 1000, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, retry_after=args.retry_after, seed=args.seed,
+                           capacity=args.capacity).start()
+    utils.set_ebi_url(server.url)
+
+    print(f"{'rows':>8} {'workers':>8} {'seconds':>9} {'rows/s':>9} {'requests':>9} {'p50 ms':>8} {'p99 ms':>8}  statuses")
+    with tempfile.TemporaryDirectory() as tmp:
+        utils.TOKEN_CACHE_DIR = Path(tmp) / "tokens"
+        for rows in args.rows:
+            for workers in args.workers:
+                result = run_benchmark(rows, workers, server, Path(tmp))
+                print(f"{result['rows']:>8} {result['workers']:>8} {result['seconds']:>9.2f} {result['rows_per_second']:>9.1f} "
+                      f"{result['requests']:>9} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}  {result['statuses']}")
+    server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+######
+# Start-up time of lightweight arch3d subcommands
+######
+
+# Modules that lightweight subcommands must not import
+HEAVY_MODULES = ["pandas", "numpy", "requests"]
+
+# Runs the CLI up to the point where it would launch Snakemake, which is not timed
+RUNNER = """
+import sys
+import arch3d.cli as cli
+cli.subprocess.run = lambda *args, **kwargs: None
+sys.argv = ["arch3d"] + sys.argv[1:]
+try:
+    cli.main()
+except SystemExit:
+    pass
+"""
+
+def command_line(args, importtime=False):
+    return [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", RUNNER] + args
+
+def time_command(command, repeats):
+    """Median wall time (ms) of running a command, including interpreter start-up."""
+    env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+def imported_modules(args):
+    """Top-level modules imported while running a subcommand, with -X importtime."""
+    env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+    result = subprocess.run(command_line(args, importtime=True), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the start-up time of lightweight arch3d subcommands")
+    parser.add_argument("--repeats", type=int, default=10, help="Runs per command. Default is 10")
+    parser.add_argument("--max-ms", type=float, default=150, help="Maximum start-up time over a bare interpreter, in milliseconds. Default is 150")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        commands = {
+            "--help": ["--help"],
+            "unlock": ["unlock", "-o", tmp],
+            "lookup --help": ["lookup", "--help"],
+        }
+        baseline = time_command([sys.executable, "-c", "pass"], args.repeats)
+        print(f"{'command':<16} {'ms':>8} {'over python':>12}  heavy modules")
+        print(f"{'(python)':<16} {baseline:>8.1f} {0:>12.1f}")
+        failed = False
+        for name, command in commands.items():
+            elapsed = time_command(command_line(command), args.repeats)
+            heavy = sorted(set(HEAVY_MODULES) & imported_modules(command))
+            print(f"{name:<16} {elapsed:>8.1f} {elapsed - baseline:>12.1f}  {', '.join(heavy) or '-'}")
+            failed |= bool(heavy) or elapsed - baseline > args.max_ms
+
+    if failed:
+        print(f"Error: a subcommand imported heavy modules or took more than {args.max_ms} ms over a bare interpreter.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+######
+# Time and peak memory of the local data-preparation steps, against a stored baseline
+######
+
+BASELINE = Path(__file__).resolve().parent / "prepare_baseline.json"
+MIN_SECONDS = 0.5  # Shorter baseline runs are too noisy to compare throughput (memory is still compared)
+CASES = ["data_dict", "run_checklists", "experiment_checklists", "sample_checklists", "microsample_checklists", "payloads", "extract_data"]
+
+RECEIPT = """<?xml version="1.0" encoding="UTF-8"?>
+<RECEIPT receiptDate="2025-01-01T00:00:00.000Z" submissionFile="submission.xml" success="true">
+     <EXPERIMENT accession="ERX{i}" alias="{alias}" status="PRIVATE"/>
+     <RUN accession="ERR{i}" alias="{alias}" status="PRIVATE"/>
+     <SAMPLE accession="ERS{i}" alias="{sample}" status="PRIVATE">
+          <EXT_ID accession="SAMEA{i}" type="biosample"/>
+     </SAMPLE>
+     <SUBMISSION accession="ERA{i}" alias="{alias}"/>
+     <MESSAGES>
+          <INFO>All objects in this submission are set to private status (HOLD).</INFO>
+     </MESSAGES>
+     <ACTIONS>ADD</ACTIONS>
+</RECEIPT>
+"""
+
+def synthetic_metadata(rows: int, output_csv: Path):
+    """Write a microsample metadata table (a superset of the macrosample one) with unique aliases."""
+    import pandas as pd
+    from arch3d.utils import EXPERIMENT_COLUMNS, MICROSAMPLE_COLUMNS
+    index = pd.RangeIndex(rows)
+    aliases = "L" + index.astype(str)
+    df = pd.DataFrame({column: "value" for column in dict.fromkeys(EXPERIMENT_COLUMNS + MICROSAMPLE_COLUMNS)}, index=index)
+    df["alias"] = aliases
+    df["sample_alias"] = "M" + index.astype(str)
+    df["forward_filename"] = aliases + "_1.fq.gz"
+    df["reverse_filename"] = aliases + "_2.fq.gz"
+    df["library_layout"] = "PAIRED"
+    df["insert_size"] = 300
+    df["sample_attribute[cryosection]"] = "C" + (index // 1000).astype(str)
+    df["sample_attribute[xpixel]"] = (index % 1000) * 20
+    df["sample_attribute[ypixel]"] = 10
+    df["sample_attribute[xcoord]"] = (index % 1000) * 10.0
+    df["sample_attribute[ycoord]"] = 5.0
+    df["sample_attribute[size]"] = 50
+    df.to_csv(output_csv, sep=",", index=False)
+
+def synthetic_receipts(rows: int, directory: Path):
+    """Write one ENA receipt per sample, in directory/{sample}/receipt.xml, and their manifest."""
+    paths = []
+    for i in range(rows):
+        path = directory / f"L{i}" / "receipt.xml"
+        os.makedirs(path.parent, exist_ok=True)
+        path.write_text(RECEIPT.format(i=i, alias=f"L{i}", sample=f"M{i}"))
+        paths.append(str(path))
+    with open(directory / "receipts.txt", "w") as f:
+        f.writelines(f"{path}\n" for path in paths)
+
+def prepare_inputs(rows: int, workdir: Path, cases):
+    """Create the synthetic inputs needed by the given cases, once per size."""
+    from biosample_throughput import synthetic_sheet
+    inputs = workdir / f"inputs_{rows}"
+    os.makedirs(inputs, exist_ok=True)
+    if not (inputs / "metadata.csv").exists() and set(cases) - {"payloads", "extract_data"}:
+        synthetic_metadata(rows, inputs / "metadata.csv")
+    if not (inputs / "sheet.csv").exists() and "payloads" in cases:
+        synthetic_sheet(rows, inputs / "sheet.csv")
+    if not (inputs / "receipts" / "receipts.txt").exists() and "extract_data" in cases:
+        synthetic_receipts(rows, inputs / "receipts")
+    return inputs
+
+def run_case(case: str, inputs: Path, output: Path):
+    """Run one case on prepared inputs and return the seconds taken by the measured step."""
+    from arch3d import utils
+    metadata = str(inputs / "metadata.csv")
+    if case == "payloads":
+        import pandas as pd
+        df = pd.read_csv(inputs / "sheet.csv", sep=",")
+        df["accession"] = ""
+        start = time.perf_counter()
+        for _ in utils.iter_payloads(df, utils.PayloadPlan(df.columns)):
+            pass
+        return time.perf_counter() - start
+    if case == "extract_data":
+        sys.path.insert(0, str(REPO_DIR / "arch3d" / "workflow" / "scripts"))
+        from merge_output import extract_data, read_manifest
+        receipts = read_manifest(inputs / "receipts" / "receipts.txt")
+        start = time.perf_counter()
+        for receipt in receipts:
+            extract_data(receipt)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if case == "data_dict":
+        utils.create_data_dict(metadata, str(inputs / "data"), str(output / "input.json"))
+    elif case == "run_checklists":
+        utils.create_run_checklists(metadata, str(output))
+    elif case == "experiment_checklists":
+        utils.create_experiment_checklists(metadata, str(output))
+    elif case == "sample_checklists":
+        utils.create_sample_checklists(metadata, str(output))
+    elif case == "microsample_checklists":
+        utils.create_microsample_checklists(metadata, str(output))
+    return time.perf_counter() - start
+
+def measure(case: str, rows: int, inputs: Path, workdir: Path, repeats: int = 3):
+    """Run a case in fresh interpreters, returning its best throughput and peak resident memory."""
+    seconds, peaks = [], []
+    for repeat in range(repeats):
+        output = workdir / f"output_{case}_{rows}_{repeat}"
+        os.makedirs(output, exist_ok=True)
+        command = [sys.executable, __file__, "--run-case", case, "--inputs", str(inputs), "--output", str(output)]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        stdout = process.stdout.read()
+        # wait4 reports the peak memory of this run alone
+        _, status, usage = os.wait4(process.pid, 0)
+        shutil.rmtree(output, ignore_errors=True)
+        if status != 0:
+            print(f"Error: case {case} failed with {rows} rows.")
+            sys.exit(1)
+        seconds.append(json.loads(stdout)["seconds"])
+        peaks.append(usage.ru_maxrss / 1024)
+    # The best run is the least disturbed by the rest of the machine
+    best = min(seconds)
+    return {"seconds": best, "rows_per_second": rows / best if best > 0 else None, "peak_mb": min(peaks)}
+
+def compare(results: dict, baseline: dict, max_slowdown: float, max_memory: float):
+    """Return the regressions of results against a baseline, as messages."""
+    regressions = []
+    for key, result in results.items():
+        reference = baseline["results"].get(key)
+        if not reference:
+            continue
+        timed = reference["seconds"] >= MIN_SECONDS and result["rows_per_second"] and reference["rows_per_second"]
+        if timed and result["rows_per_second"] < reference["rows_per_second"] * (1 - max_slowdown):
+            regressions.append(f"{key}: {result['rows_per_second']:.0f} rows/s, baseline {reference['rows_per_second']:.0f} rows/s")
+        if result["peak_mb"] > reference["peak_mb"] * (1 + max_memory):
+            regressions.append(f"{key}: peak {result['peak_mb']:.0f} MB, baseline {reference['peak_mb']:.0f} MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local data-preparation steps of arch3d on synthetic inputs")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100000, 1000000], help="Input sizes to benchmark. Default is 1000 100000 1000000")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES, help="Steps to benchmark. Default is all")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per case and size; the best one is kept. Default is 3")
+    parser.add_argument("--workdir", default=None, help="Directory for the synthetic inputs, kept between runs. Default is a temporary directory")
+    parser.add_argument("--baseline", default=str(BASELINE), help=f"Baseline file. Default is {BASELINE.name} next to this script")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline instead of comparing against it")
+    parser.add_argument("--max-slowdown", type=float, default=0.25, help="Largest accepted drop in throughput, as a fraction of the baseline. Default is 0.25")
+    parser.add_argument("--max-memory", type=float, default=0.25, help="Largest accepted increase in peak memory, as a fraction of the baseline. Default is 0.25")
+    parser.add_argument("--run-case", choices=CASES, help=argparse.SUPPRESS)
+    parser.add_argument("--inputs", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process measuring a single case
+    if args.run_case:
+        print(json.dumps({"seconds": run_case(args.run_case, Path(args.inputs), Path(args.output))}))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(args.workdir or tmp)
+        print(f"{'case':<24} {'rows':>9} {'seconds':>9} {'rows/s':>11} {'peak MB':>9}")
+        for rows in args.rows:
+            inputs = prepare_inputs(rows, workdir, args.cases)
+            for case in args.cases:
+                result = measure(case, rows, inputs, workdir, args.repeats)
+                results[f"{case}/{rows}"] = result
+                print(f"{case:<24} {rows:>9} {result['seconds']:>9.2f} {result['rows_per_second'] or 0:>11.0f} {result['peak_mb']:>9.0f}")
+
+    if args.save_baseline:
+        # Keep the results of cases and sizes that were not run this time
+        baseline = {"results": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        baseline["results"].update(results)
+        baseline["machine"] = {"node": platform.node(), "processor": platform.processor(), "python": platform.python_version(), "cpus": os.cpu_count()}
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Baseline saved: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        # Without a baseline nothing is checked, which must not pass for a successful run
+        print(f"Error: No baseline found at {args.baseline}. Run with --save-baseline on the reference machine to create one.")
+        sys.exit(1)
+    with open(args.baseline, "r") as f:
+        regressions = compare(results, json.load(f), args.max_slowdown, args.max_memory)
+    if regressions:
+        print(f"Error: {len(regressions)} regressions against the baseline:")
+        for regression in regressions:
+            print(f"    {regression}")
+        sys.exit(1)
+    print("No regressions against the baseline.")
+
+if __name__ == "__main__":
+    main()